@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Bytes per instance and attribute access speed of ``CompactModel``
+versus the dict based ``Model``.
+
+usage::
+
+    python benchmarks/compact_model.py [instances]
+"""
+import os
+import sys
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from bson import ObjectId  # noqa: E402
+from mongu import Model  # noqa: E402
+
+
+class User(Model):
+    _database_ = 'bench'
+    _collection_ = 'users'
+    _defaults_ = {'is_activated': False, 'created_at': time.time,
+                  'role': 'user', 'age': 0}
+    _fields_ = ('username', 'email')
+
+
+def documents(num):
+    for i in range(num):
+        yield {'_id': ObjectId(), 'username': 'user%d' % i,
+               'email': 'user%d@example.com' % i, 'is_activated': i % 2 == 0,
+               'created_at': float(i), 'role': 'user', 'age': i % 90}
+
+
+def bytes_per_instance(build, num):
+    docs = list(documents(num))
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objs = [build(d) for d in docs]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'lineno'))
+    return size / float(len(objs)), objs[0]
+
+
+def main(num=100000):
+    compact_cls = User.compact_class()
+    for name, build in (('Model', User._hydrate),
+                        ('CompactModel', compact_cls._from_document)):
+        size, obj = bytes_per_instance(build, num)
+        seconds = min(timeit.repeat(lambda: obj.username, number=1000000,
+                                    repeat=3))
+        print('%-13s %7.0f bytes/instance  %6.1f ns/attribute access' % (
+            name, size, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""Throughput of mongu's hot paths, stored as JSON to compare versions.
+
+Benchmarks needing a collection run against ``mongomock`` (in-process, the
+default) or a local ``mongod``, the ``raw_*`` ones call the driver directly
+so that its cost can be told apart from mongu's overhead. With the ``none``
+backend only the benchmarks without I/O run.
+
+usage::
+
+    pip install mongomock
+    python benchmarks/hot_paths.py --output 0.4.4.json
+    python benchmarks/hot_paths.py --compare 0.4.4.json
+    python benchmarks/hot_paths.py --backend mongod --only save
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import mongu  # noqa: E402
+from bson import ObjectId  # noqa: E402
+from mongu import Client, Model  # noqa: E402
+
+# the clock of mongu's metrics
+timer = mongu._timer
+
+
+class User(Model):
+    _database_ = 'mongu_bench'
+    _collection_ = 'users'
+    _defaults_ = {'is_activated': False, 'created_at': time.time,
+                  'role': 'user', 'age': 0}
+
+
+def new_document(i):
+    """Fields of a document not saved yet, ``_id`` is assigned on insert."""
+    return {'username': 'user%d' % i, 'email': 'user%d@example.com' % i,
+            'is_activated': i % 2 == 0, 'created_at': float(i),
+            'role': 'user', 'age': i % 90}
+
+
+def document(i):
+    """Fields of a stored document."""
+    d = new_document(i)
+    d['_id'] = ObjectId()
+    return d
+
+
+def connect(backend):
+    """Return a ``Client`` for ``backend``, ``None`` for ``none``."""
+    if backend == 'none':
+        return None
+    client = Client(connect=False)
+    if backend == 'mongomock':
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('mongomock is required: pip install mongomock')
+        client.client = mongomock.MongoClient()
+    return client
+
+
+class Context(object):
+    """Registered models of a backend, dropped collections afterwards."""
+    def __init__(self, client):
+        self.client = client
+        self.User = client.register_model(
+            type('User', (User,), {}))
+        self.Counter, CounterMixin = client.enable_counter(
+            database='mongu_bench')
+        self.CountedUser = client.register_model(
+            type('CountedUser', (CounterMixin, User),
+                 {'_collection_': 'counted_users'}))
+
+    def close(self):
+        for model_cls in (self.User, self.CountedUser, self.Counter):
+            model_cls.collection.drop()
+
+
+def bench_instantiate(ctx, number):
+    start = timer()
+    for i in range(number):
+        User(username='mongu', email='mongu@example.com')
+    return timer() - start
+
+
+def bench_hydrate(ctx, number):
+    docs = [document(i) for i in range(number)]
+    start = timer()
+    for obj in User.from_cursor(docs):
+        pass
+    return timer() - start
+
+
+def bench_raw_insert_one(ctx, number):
+    docs = [new_document(i) for i in range(number)]
+    collection = ctx.User.collection
+    start = timer()
+    for d in docs:
+        collection.insert_one(d)
+    return timer() - start
+
+
+def _save(objs):
+    start = timer()
+    for obj in objs:
+        obj.save()
+    return timer() - start
+
+
+def bench_save_new(ctx, number):
+    return _save([ctx.User(new_document(i)) for i in range(number)])
+
+
+def bench_save_new_counted(ctx, number):
+    seconds = _save([ctx.CountedUser(new_document(i)) for i in range(number)])
+    assert ctx.CountedUser.count() == number, 'inserts were not counted'
+    return seconds
+
+
+def bench_save_existing(ctx, number):
+    objs = [ctx.User(new_document(i)) for i in range(number)]
+    for obj in objs:
+        obj.save()
+        obj.age += 1
+    return _save(objs)
+
+
+def bench_raw_find_one(ctx, number):
+    ids = ctx.User.collection.insert_many(
+        [document(i) for i in range(number)]).inserted_ids
+    collection = ctx.User.collection
+    start = timer()
+    for oid in ids:
+        collection.find_one(oid)
+    return timer() - start
+
+
+def bench_by_id(ctx, number):
+    ids = ctx.User.collection.insert_many(
+        [document(i) for i in range(number)]).inserted_ids
+    start = timer()
+    for oid in ids:
+        ctx.User.by_id(oid)
+    return timer() - start
+
+
+def bench_change_by_threads(ctx, number, threads=8):
+    def work():
+        for i in range(number // threads):
+            ctx.Counter.change_by('bench', 1)
+
+    workers = [threading.Thread(target=work) for i in range(threads)]
+    start = timer()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return timer() - start
+
+
+# name, function, whether a collection is needed
+BENCHMARKS = [
+    ('instantiate', bench_instantiate, False),
+    ('hydrate', bench_hydrate, False),
+    ('raw_insert_one', bench_raw_insert_one, True),
+    ('save_new', bench_save_new, True),
+    ('save_new_counted', bench_save_new_counted, True),
+    ('save_existing', bench_save_existing, True),
+    ('raw_find_one', bench_raw_find_one, True),
+    ('by_id', bench_by_id, True),
+    ('change_by_threads', bench_change_by_threads, True),
+]
+
+
+def run(backend, number, repeat, only=None):
+    """Run the benchmarks, return their best of ``repeat`` rounds."""
+    client = connect(backend)
+    results = {}
+    for name, func, needs_db in BENCHMARKS:
+        if only and not any(part in name for part in only):
+            continue
+        if needs_db and client is None:
+            continue
+        # I/O bound benchmarks are slower, run less of them
+        count = number // 10 if needs_db else number
+        best = None
+        for i in range(repeat):
+            ctx = Context(client) if needs_db else None
+            try:
+                seconds = func(ctx, count)
+            finally:
+                if ctx is not None:
+                    ctx.close()
+            best = seconds if best is None else min(best, seconds)
+        results[name] = {'number': count,
+                         'us_per_op': best / count * 1e6,
+                         'ops_per_sec': count / best if best else None}
+    return {'mongu': mongu.__version__,
+            'python': platform.python_version(),
+            'backend': backend,
+            'created_at': time.time(),
+            'results': results}
+
+
+def report(results, baseline=None):
+    base = baseline['results'] if baseline else {}
+    for name, result in sorted(results['results'].items()):
+        line = '%-18s %10.2f us/op' % (name, result['us_per_op'])
+        if name in base:
+            line += '  %5.2fx vs %s' % (
+                base[name]['us_per_op'] / result['us_per_op'],
+                baseline['mongu'])
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--backend', default='mongomock',
+                        choices=('mongomock', 'mongod', 'none'))
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', action='append',
+                        help='run benchmarks whose name contains this')
+    parser.add_argument('--output', help='store the results in this file')
+    parser.add_argument('--compare', help='results file to compare with')
+    args = parser.parse_args(argv)
+
+    results = run(args.backend, args.number, args.repeat, args.only)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
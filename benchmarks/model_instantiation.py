@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Instantiation throughput of ``Model`` subclasses with inherited
+``_defaults_``.
+
+``legacy`` reproduces the per-instance merging of mongu <= 0.4.4, ``current``
+uses the defaults precomputed by ``ModelMeta``.
+
+usage::
+
+    python benchmarks/model_instantiation.py [depth] [number]
+"""
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from mongu import Model, ObjectDict  # noqa: E402
+
+
+class LegacyModel(ObjectDict):
+    _defaults_ = {}
+
+    def __new__(cls, *args, **kwargs):
+        defaults = {}
+        for b_cls in cls.__bases__:
+            defaults.update(getattr(b_cls, '_defaults_', {}))
+        defaults.update(getattr(cls, '_defaults_', {}))
+        cls._defaults_ = defaults
+
+        instance = super(LegacyModel, cls).__new__(cls, *args, **kwargs)
+        for k, v in cls._defaults_.items():
+            value = v() if callable(v) else v
+            instance.setdefault(k, value)
+        return instance
+
+
+def hierarchy(base, depth):
+    """Build a ``User -> Admin -> Admin1 ...`` chain of ``depth`` classes."""
+    cls = type('User', (base,), {'_defaults_': {'is_activated': False,
+                                                'created_at': time.time}})
+    for i in range(1, depth):
+        cls = type('Admin%d' % i, (cls,), {
+            '_defaults_': {'role': 'admin', 'level_%d' % i: i}})
+    return cls
+
+
+def main(depth=5, number=200000):
+    for name, base in (('legacy', LegacyModel), ('current', Model)):
+        cls = hierarchy(base, depth)
+        seconds = min(timeit.repeat(lambda: cls(username='mongu'),
+                                    repeat=3, number=number))
+        print('%-8s depth=%d  %10.0f instances/s' % (
+            name, depth, number / seconds))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
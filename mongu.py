@@ -2,16 +2,59 @@
 
 __version__ = '0.4.4'
 
+import atexit
+import base64
+import functools
+import gzip
 import logging
+import os
+import random
+import re
+import threading
+import time
 import warnings
-from collections import Callable
-from bson import ObjectId
-from pymongo import MongoClient
-from pymongo.errors import ConfigurationError
+import weakref
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from bson import BSON, ObjectId, decode_file_iter, json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient, IndexModel, InsertOne, ReplaceOne, \
+    UpdateOne, UpdateMany, ReturnDocument
+from pymongo.errors import BulkWriteError, OperationFailure, \
+    PyMongoError
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, \
+    Secondary, SecondaryPreferred
+
+
+# live clients, reset in forked children
+_clients = weakref.WeakSet()
+# live ``CounterBuffer`` objects, emptied in forked children
+_buffers = weakref.WeakSet()
+
+
+def _uri_database(uri):
+    """Return the database name in the path of a MongoDB ``uri``."""
+    if not hasattr(uri, 'split') or '://' not in uri:
+        return ''
+    rest = uri.split('://', 1)[1]
+    path = rest.split('/', 1)[1] if '/' in rest else ''
+    return path.split('?', 1)[0]
 
 
 class Client(object):
-    """For Connecting to MongoDB and registering model classes."""
+    """For Connecting to MongoDB and registering model classes.
+
+    The ``MongoClient`` is created on first use of ``client``, e.g. the
+    first query of a registered model, or by ``warm_up()``. A forked
+    process, such as a pre-fork server worker, creates its own one and
+    rebinds the collections of registered models."""
+    client_class = MongoClient
+
     def __init__(self, *args, **kwargs):
         """Accept arguments same as ``MongoClient``.
 
@@ -20,17 +63,69 @@ class Client(object):
             >> Client('localhost', 27017)
             >> Client('mongodb://localhost:27017')
         """
-        self.client = MongoClient(*args, **kwargs)
-        try:
-            db = self.client.get_default_database()
-        except ConfigurationError:
-            # make sure database is not provided in URI
-            pass
-        else:
+        self._args = args
+        self._kwargs = kwargs
+        self._client = None
+        self._pid = None
+        self._models = []
+        self._unindexed = []
+        self._lock = threading.Lock()
+        _clients.add(self)
+        # make sure database is not provided in URI
+        db = _uri_database(kwargs.get('host', args[0] if args else None))
+        if db:
             warnings.warn(
                 'Database: %s in URI will not work' % db,
                 SyntaxWarning, stacklevel=2)
 
+    @property
+    def client(self):
+        """The driver client of this process, created on first use."""
+        client = self._client
+        if client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    self._reset()
+                    self._client = self.client_class(*self._args,
+                                                     **self._kwargs)
+                    self._pid = os.getpid()
+                client = self._client
+        return client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+        self._pid = os.getpid()
+        for model_cls in self._models:
+            model_cls._unbind_collection()
+
+    def __getitem__(self, name):
+        return self.client[name]
+
+    def _reset(self):
+        """Forget the client and collections inherited from a parent
+        process."""
+        self._client = None
+        for model_cls in self._models:
+            model_cls._unbind_collection()
+
+    def warm_up(self, connections=1):
+        """Connect now and open ``connections`` pooled connections with
+        concurrent pings, then bind the collections of registered models, so
+        that the first requests do not pay for it."""
+        client = self.client
+        if connections > 1:
+            pool = ThreadPool(connections)
+            try:
+                pool.map(lambda i: client.admin.command('ping'),
+                         range(connections))
+            finally:
+                pool.close()
+        else:
+            client.admin.command('ping')
+        for model_cls in self._models:
+            model_cls.collection
+
     def register_model(self, model_cls):
         """Decorator for registering model."""
         if not getattr(model_cls, '_database_'):
@@ -40,13 +135,66 @@ class Client(object):
             raise ModelAttributeError('_collection_ missing '
                                       'on %s!' % model_cls.__name__)
 
-        model_cls._mongo_client_ = self.client
+        model_cls._mongo_client_ = self
+        if model_cls not in self._models:
+            self._models.append(model_cls)
+        if model_cls._indexes_ and model_cls._auto_index_:
+            self._auto_index(model_cls)
 
         logging.info('Registering Model ' + model_cls.__name__)
         return model_cls
 
+    def _auto_index(self, model_cls):
+        """Queue declared indexes of a model being registered, they are
+        created on first use of its collection."""
+        with self._lock:
+            if model_cls not in self._unindexed:
+                self._unindexed.append(model_cls)
+
+    def _on_bind(self, model_cls):
+        """Create the queued indexes of ``model_cls`` once its collection is
+        first used."""
+        if model_cls not in self._unindexed:
+            return
+        with self._lock:
+            if model_cls not in self._unindexed:
+                return
+            self._unindexed.remove(model_cls)
+        if model_cls._auto_index_ == 'background':
+            thread = threading.Thread(target=self._create_indexes,
+                                      args=(model_cls,))
+            thread.daemon = True
+            thread.start()
+        else:
+            self._create_indexes(model_cls)
+
+    def _create_indexes(self, model_cls):
+        """Create the declared indexes of ``model_cls`` on first use of its
+        collection. A failure is logged rather than raised from an unrelated
+        query, and the model is queued again for ``ensure_indexes()``."""
+        try:
+            model_cls.ensure_indexes()
+        except Exception:
+            logging.exception('Failed to create indexes of %s, queued for '
+                              'ensure_indexes()' % model_cls.__name__)
+            self._auto_index(model_cls)
+
+    def ensure_indexes(self):
+        """Create the declared indexes of registered models whose collection
+        was not used yet, e.g. at application startup."""
+        with self._lock:
+            unindexed, self._unindexed = self._unindexed, []
+        for i, model_cls in enumerate(unindexed):
+            try:
+                model_cls.ensure_indexes()
+            except Exception:
+                for model_cls in unindexed[i:]:
+                    self._auto_index(model_cls)
+                raise
+
     def enable_counter(self, base=None, database='counter',
-                       collection='counters'):
+                       collection='counters', buffered=False,
+                       flush_interval=1.0, flush_size=1000, shards=None):
         """Register the builtin counter model, return the registered Counter
         class and the corresponding ``CounterMixin`` class.
 
@@ -54,11 +202,50 @@ class Client(object):
         after model creation(save without ``_id``) and deletion.
 
         It contains a classmethod ``count()`` which returns the current count
-        of the model collection."""
+        of the model collection.
+
+        With ``buffered`` the changes made by ``CounterMixin`` are kept in a
+        ``CounterBuffer`` and written behind every ``flush_interval`` seconds,
+        after ``flush_size`` changes or at exit, ``count()`` includes the
+        changes not written yet.
+
+        ``shards`` maps counter names to the number of documents they are
+        spread over, see ``Counter.shard()``."""
         Counter._database_ = database
         Counter._collection_ = collection
         bases = (base, Counter) if base else (Counter,)
-        counter = self.register_model(type('Counter', bases, {}))
+        counter = self.register_model(type('Counter', bases, {
+            '_shards_': dict(shards or {})}))
+        buffer = (CounterBuffer(counter, flush_interval, flush_size)
+                  if buffered else None)
+        local = threading.local()
+
+        def change_counter(name, num):
+            deltas = getattr(local, 'deltas', None)
+            if deltas is not None:
+                deltas[name] = deltas.get(name, 0) + num
+            elif buffer:
+                buffer.change_by(name, num)
+            else:
+                counter.change_many({name: num})
+
+        @contextmanager
+        def batch_counter():
+            """Accumulate counter changes made in this thread, apply them
+            at once on exit."""
+            if getattr(local, 'deltas', None) is not None:
+                yield
+                return
+            local.deltas = deltas = {}
+            try:
+                yield
+            finally:
+                local.deltas = None
+                if buffer:
+                    for name, num in deltas.items():
+                        buffer.change_by(name, num)
+                else:
+                    counter.change_many(deltas)
 
         class CounterMixin(object):
             """Mixin class for model"""
@@ -85,18 +272,44 @@ class Client(object):
             def on_save(self, old_dict):
                 super(CounterMixin, self).on_save(old_dict)
                 if not old_dict.get('_id'):
-                    counter.increase(self._collection_)
+                    change_counter(self._collection_, 1)
 
             def on_delete(self, *args, **kwargs):
                 super(CounterMixin, self).on_delete(*args, **kwargs)
-                counter.decrease(self._collection_)
+                change_counter(self._collection_, -1)
+
+            @classmethod
+            def on_save_many(cls, objs, old_dicts):
+                with batch_counter():
+                    super(CounterMixin, cls).on_save_many(objs, old_dicts)
+
+            @classmethod
+            def on_delete_many(cls, objs):
+                with batch_counter():
+                    super(CounterMixin, cls).on_delete_many(objs)
+
+            @classmethod
+            def on_import(cls, count):
+                super(CounterMixin, cls).on_import(count)
+                change_counter(cls._collection_, count)
 
             @classmethod
             def count(cls):
                 """Return the current count of this collection."""
-                return counter.count(cls._collection_)
+                num = counter.count(cls._collection_)
+                if buffer:
+                    num += buffer.pending(cls._collection_)
+                return num
+
+            @classmethod
+            def flush_counter(cls):
+                """Write buffered counter changes, if any, return the changes
+                rejected because they would make a counter negative."""
+                if buffer:
+                    return buffer.flush()
+                return {}
 
-        logging.info('Counter enabled on: %s' % counter.collection)
+        logging.info('Counter enabled on: %s.%s' % (database, collection))
         return counter, CounterMixin
 
 
@@ -113,6 +326,172 @@ class ObjectDict(dict):
         self[name] = value
 
 
+_BULK_OPS = {
+    'insert_one': InsertOne,
+    'replace_one': ReplaceOne,
+    'update_one': UpdateOne,
+}
+
+
+# active ``Metrics``, ``None`` disables instrumentation
+_metrics = None
+# only the outermost operation of a thread is recorded
+_instrumenting = threading.local()
+
+
+# monotonic and high resolution, time.time() on Python 2
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def _instrumented(op):
+    """Decorator recording calls of a model or counter operation in the
+    active ``Metrics``, a single global lookup when disabled."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(owner, *args, **kwargs):
+            metrics = _metrics
+            if metrics is None or getattr(_instrumenting, 'active', False):
+                return func(owner, *args, **kwargs)
+            model_cls = owner if isinstance(owner, type) else type(owner)
+            _instrumenting.active = True
+            start = _timer()
+            try:
+                result = func(owner, *args, **kwargs)
+            except Exception:
+                metrics.record(model_cls, op, _timer() - start, error=True)
+                raise
+            finally:
+                _instrumenting.active = False
+            metrics.record(model_cls, op, _timer() - start,
+                           docs=_count_docs(result))
+            return result
+        return wrapper
+    return decorator
+
+
+def _count_docs(result):
+    if isinstance(result, Model):
+        return 1
+    if isinstance(result, dict):
+        # columns of find_columns, one row per document
+        for column in result.values():
+            return len(column) if isinstance(column, Column) else 0
+        return 0
+    if isinstance(result, list):
+        return sum(1 for obj in result if isinstance(obj, dict))
+    return 0
+
+
+# read preference of ``read_from()`` blocks and primary pins per thread
+_routing = threading.local()
+
+_READ_MODES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+def _read_preference(read, max_staleness=-1):
+    """Return ``read``, a mode name or pymongo read preference, as a read
+    preference, ``max_staleness`` applies to mode names but primary."""
+    if hasattr(read, 'mongos_mode'):
+        return read
+    mode = _READ_MODES.get(read)
+    if mode is None:
+        raise MonguException('Unknown read mode %r' % read)
+    if mode is Primary:
+        return Primary()
+    return mode(max_staleness=max_staleness)
+
+
+@contextmanager
+def read_from(read, max_staleness=-1):
+    """Route reads of all models in this block and thread to ``read``, a
+    mode name such as ``'nearest'`` or a pymongo read preference. Reads
+    passing ``read=`` and reads pinned to the primary after a save are not
+    affected.
+
+    example::
+
+        >> with read_from('secondary', max_staleness=90):
+        >>     report = list(Order.find({'paid': True}))
+    """
+    previous = getattr(_routing, 'read', None)
+    _routing.read = _read_preference(read, max_staleness)
+    try:
+        yield
+    finally:
+        _routing.read = previous
+
+
+def _unwritten(error, sent, ordered):
+    """Return the ``id()`` of the model objects of ``sent``, in the order of
+    their bulk requests, not written by the bulk write raising ``error``."""
+    if not isinstance(error, BulkWriteError):
+        return set(id(obj) for obj in sent)
+    indexes = [e['index'] for e in error.details.get('writeErrors', ())]
+    if ordered:
+        # the requests after the first error were not sent
+        indexes = range(min(indexes), len(sent)) if indexes else ()
+    return set(id(sent[i]) for i in indexes)
+
+
+def _chunked(iterable, size):
+    """Yield lists of at most ``size`` items from ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _get_path(d, path):
+    """Return the value of dotted ``path`` (list of keys) in ``d``, ``None``
+    if missing."""
+    value = d
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def _open_dump(path, mode, compress=False):
+    """Open a file of ``Model.export``, gzipped if ``compress`` or if
+    ``path`` ends with ``.gz``."""
+    if compress or path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _skip_until(docs, after):
+    """Skip documents of an ``_id`` ordered iterable up to ``after``."""
+    for doc in docs:
+        if doc['_id'] > after:
+            yield doc
+            break
+    for doc in docs:
+        yield doc
+
+
+def _scan_range(task):
+    """Scan an ``_id`` range for ``Model.parallel_scan``."""
+    model_cls, query, lower, upper, fn, fields = task
+    id_range = {}
+    if lower is not None:
+        id_range['$gte'] = lower
+    if upper is not None:
+        id_range['$lt'] = upper
+    if id_range:
+        query = {'$and': [query or {}, {'_id': id_range}]}
+    objs = model_cls.find(query, fields=fields)
+    if fn is None:
+        return list(objs)
+    return [fn(obj) for obj in objs]
+
+
 class class_property(object):
     """Calls the decorator method on class attribute access."""
     def __init__(self, getter):
@@ -122,59 +501,360 @@ class class_property(object):
         return self.getter(owner)
 
 
-class Model(ObjectDict):
+class ModelMeta(type):
+    """Metaclass of ``Model``, resolves ``_defaults_`` along the MRO once
+    per class instead of once per instance, and drops the cached
+    collection when attributes it is bound from change."""
+    binding_attrs = frozenset(['_mongo_client_', '_database_',
+                               '_collection_', '_read_preference_',
+                               '_read_concern_', '_write_concern_',
+                               '_codec_options_', '_max_staleness_'])
+
+    def __init__(cls, name, bases, attrs):
+        super(ModelMeta, cls).__init__(name, bases, attrs)
+        cls._merge_defaults()
+
+    def __setattr__(cls, name, value):
+        super(ModelMeta, cls).__setattr__(name, value)
+        if name == '_defaults_':
+            cls._merge_defaults()
+        elif name in ModelMeta.binding_attrs:
+            cls._unbind_collection()
+
+    def __delattr__(cls, name):
+        super(ModelMeta, cls).__delattr__(name)
+        if name == '_defaults_':
+            cls._merge_defaults()
+        elif name in ModelMeta.binding_attrs:
+            cls._unbind_collection()
+
+    def _unbind_collection(cls):
+        """Drop the cached collections of ``cls`` and its subclasses."""
+        for name in ('_bound_collection_', '_bound_reads_'):
+            if name in vars(cls):
+                type.__delattr__(cls, name)
+        for sub_cls in cls.__subclasses__():
+            sub_cls._unbind_collection()
+
+    def _merge_defaults(cls):
+        """Split the merged ``_defaults_`` of ``cls`` into constant values and
+        factories, then refresh subclasses which may inherit from it."""
+        defaults = {}
+        for klass in reversed(cls.__mro__):
+            defaults.update(vars(klass).get('_defaults_') or {})
+
+        values, factories = {}, []
+        for k, v in defaults.items():
+            if callable(v):
+                factories.append((k, v))
+            else:
+                values[k] = v
+        type.__setattr__(cls, '_default_values_', values)
+        type.__setattr__(cls, '_default_factories_', tuple(factories))
+        if '_compact_class_' in vars(cls):
+            type.__delattr__(cls, '_compact_class_')
+
+        for sub_cls in cls.__subclasses__():
+            sub_cls._merge_defaults()
+
+
+class Model(ModelMeta('ModelBase', (ObjectDict,), {})):
     """Dict-like class with optional default key-values
     that binds to a collection."""
     _mongo_client_ = None
     _database_ = None
     _collection_ = None
     _defaults_ = {}
+    # keys changed since load, ``None`` means the document is saved as whole
+    _changed_ = None
+    # optional ``IdentityMap`` for ``by_id``
+    _cache_ = None
+    # index specs, see ``index_models()``
+    _indexes_ = []
+    # create ``_indexes_`` on first use of the collection: 'lazy' (or True),
+    # 'background' to create them in a thread, or False
+    _auto_index_ = 'lazy'
+    # extra keys stored in slots of ``compact_class()``
+    _fields_ = ()
+    # projection of partial model objects, ``None`` when fully loaded
+    _projection_ = None
+    _lazy_ = False
+    # optional options of the collection, ``None`` inherits from the client,
+    # ``_read_preference_`` may be a mode name such as ``'nearest'``
+    _read_preference_ = None
+    _read_concern_ = None
+    _write_concern_ = None
+    _codec_options_ = None
+    # ``maxStalenessSeconds`` of secondary reads by mode name, -1 for none
+    _max_staleness_ = -1
+    # seconds reads of this thread go to the primary after it saved
+    _read_your_writes_ = 1.0
 
     @class_property
     def collection(self):
-        if not self._mongo_client_:
+        collection = vars(self).get('_bound_collection_')
+        if collection is None:
+            collection = self._bind_collection()
+        return collection
+
+    @classmethod
+    def _bind_collection(cls):
+        """Resolve the collection with the options of this model and cache
+        it on the class until the client or names change."""
+        if not cls._mongo_client_:
             raise ModelAttributeError('collection is not available before '
                                       'registration!')
-        return getattr(self._mongo_client_[self._database_], self._collection_)
+        collection = cls._mongo_client_[cls._database_][cls._collection_]
+        options = {}
+        for option in ('read_preference', 'read_concern', 'write_concern',
+                       'codec_options'):
+            value = getattr(cls, '_%s_' % option)
+            if value is not None:
+                options[option] = value
+        if 'read_preference' in options:
+            options['read_preference'] = _read_preference(
+                options['read_preference'], cls._max_staleness_)
+        if options:
+            collection = collection.with_options(**options)
+        type.__setattr__(cls, '_bound_collection_', collection)
+        on_bind = getattr(cls._mongo_client_, '_on_bind', None)
+        if on_bind is not None:
+            on_bind(cls)
+        return collection
 
-    def __new__(cls, *args, **kwargs):
-        """set defaults for instance of model"""
-        # merge _defaults_ from base classes
-        defaults = {}
-        for b_cls in cls.__bases__:
-            defaults.update(getattr(b_cls, '_defaults_', {}))
+    @classmethod
+    def _routing(cls):
+        """Return the read preference of the current ``read_from()`` block
+        and the primary pins of this thread."""
+        pins = getattr(_routing, 'pins', None)
+        if pins is None:
+            pins = _routing.pins = {}
+        return getattr(_routing, 'read', None), pins
 
-        # override with subclass's _defaults_
-        defaults.update(getattr(cls, '_defaults_', {}))
-        cls._defaults_ = defaults
+    @classmethod
+    def _reader(cls, read=None):
+        """Return the collection to read from with ``read``, else the read
+        preference of the ``read_from()`` block, else the options of this
+        model. Reads go to the primary shortly after a save of this thread
+        to the collection."""
+        routed, pins = cls._routing()
+        if pins:
+            key = cls._database_, cls._collection_
+            until = pins.get(key)
+            if until is not None:
+                if until > time.time():
+                    read = 'primary'
+                else:
+                    del pins[key]
+        if read is None:
+            read = routed
+            if read is None:
+                return cls.collection
+        pref = _read_preference(read, cls._max_staleness_)
+        reads = vars(cls).get('_bound_reads_')
+        if reads is None:
+            reads = {}
+            type.__setattr__(cls, '_bound_reads_', reads)
+        key = repr(pref)
+        collection = reads.get(key)
+        if collection is None:
+            collection = reads[key] = cls.collection.with_options(
+                read_preference=pref)
+        return collection
+
+    @classmethod
+    def _pin_primary(cls):
+        """Route reads of this thread to the primary for
+        ``_read_your_writes_`` seconds."""
+        if cls._read_your_writes_:
+            cls._routing()[1][cls._database_, cls._collection_] = \
+                time.time() + cls._read_your_writes_
 
-        # set default to instance
+    def __new__(cls, *args, **kwargs):
+        """set defaults for instance of model"""
+        # defaults are merged by ``ModelMeta`` at class creation
         instance = super(Model, cls).__new__(cls, *args, **kwargs)
-        for k, v in cls._defaults_.items():
-            value = v() if isinstance(v, Callable) else v
-            instance.setdefault(k, value)
+        dict.update(instance, cls._default_values_)
+        for k, factory in cls._default_factories_:
+            dict.__setitem__(instance, k, factory())
 
         return instance
 
+    def __setitem__(self, key, value):
+        super(Model, self).__setitem__(key, value)
+        self._mark_changed((key,))
+
+    def __delitem__(self, key):
+        super(Model, self).__delitem__(key)
+        self._mark_changed((key,))
+
+    def update(self, *args, **kwargs):
+        d = dict(*args, **kwargs)
+        super(Model, self).update(d)
+        self._mark_changed(d)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            self._mark_changed((key,))
+        return super(Model, self).pop(key, *args)
+
+    def popitem(self):
+        item = super(Model, self).popitem()
+        self._mark_changed((item[0],))
+        return item
+
+    def clear(self):
+        self._mark_changed(list(self))
+        super(Model, self).clear()
+
+    def _mark_changed(self, keys):
+        changed = self._changed_
+        if changed is None:
+            return
+        if not isinstance(changed, set):
+            changed = self.__dict__['_changed_'] = set()
+        changed.update(keys)
+
+    def mark_changed(self, *keys):
+        """Mark ``keys`` as modified, needed after mutating a nested value
+        in place, e.g. ``user.profile['age'] = 18``."""
+        self._mark_changed(keys)
+
     def __repr__(self):
         return '%s(%s)' % (self.__class__.__name__,
                            super(Model, self).__repr__())
 
     @classmethod
-    def by_id(cls, oid):
+    @_instrumented('by_id')
+    def by_id(cls, oid, fields=None, lazy=False, read=None):
         """Find a model object by its ``ObjectId``,
-        ``oid`` can be string or ObjectId"""
+        ``oid`` can be string or ObjectId.
+
+        ``fields``, ``lazy`` and ``read`` are the same as in ``find``."""
+        if oid and fields is not None:
+            return cls.find_one(ObjectId(oid), fields=fields, lazy=lazy,
+                                read=read)
         if oid:
-            d = cls.collection.find_one(ObjectId(oid))
+            oid = ObjectId(oid)
+            cache = cls._cache_
+            if cache is not None:
+                obj = cache.get(cls, oid)
+                if obj is not None:
+                    return obj
+            d = cls._reader(read).find_one(oid)
             if d:
-                return cls(**d)
+                obj = cls._hydrate(d)
+                if cache is not None:
+                    cache.put(obj)
+                return obj
+
+    @classmethod
+    def index_models(cls):
+        """Return ``_indexes_`` as a list of ``IndexModel``.
+
+        An index spec is a key name, a list of ``(key, direction)``, a dict
+        of ``keys`` and ``IndexModel`` options such as ``unique``,
+        ``sparse``, ``expireAfterSeconds`` or ``partialFilterExpression``,
+        or an ``IndexModel``."""
+        models = []
+        for spec in cls._indexes_:
+            if isinstance(spec, IndexModel):
+                models.append(spec)
+            elif isinstance(spec, dict):
+                options = dict(spec)
+                models.append(IndexModel(options.pop('keys'), **options))
+            else:
+                models.append(IndexModel(spec))
+        return models
+
+    @classmethod
+    def ensure_indexes(cls):
+        """Create the indexes declared in ``_indexes_``, existing ones are
+        left untouched. Return their names."""
+        models = cls.index_models()
+        if models:
+            return cls.collection.create_indexes(models)
+        return []
+
+    @classmethod
+    def index_diff(cls):
+        """Compare declared indexes with the ones of the collection, return
+        a dict of index names ``missing`` on the collection, ``extra`` ones
+        not declared and ``changed`` ones with different options."""
+        return cls._diff_indexes(cls.collection.index_information())
+
+    @classmethod
+    def _diff_indexes(cls, existing):
+        existing = dict(existing)
+        existing.pop('_id_', None)
+        diff = {'missing': [], 'extra': [], 'changed': []}
+        for model in cls.index_models():
+            declared = dict(model.document)
+            name = declared.pop('name')
+            keys = list(declared.pop('key').items())
+            info = existing.pop(name, None)
+            if info is None:
+                diff['missing'].append(name)
+                continue
+            info = dict(info)
+            info.pop('v', None)
+            info.pop('ns', None)
+            if ([(k, int(d)) if isinstance(d, float) else (k, d)
+                 for k, d in info.pop('key')] != keys or
+                    any(info.get(k) != v for k, v in declared.items()
+                        if k != 'background') or
+                    any(k not in declared for k in info
+                        if k != 'background')):
+                diff['changed'].append(name)
+        diff['extra'] = sorted(existing)
+        return diff
+
+    @classmethod
+    @_instrumented('by_ids')
+    def by_ids(cls, oids, read=None):
+        """Find model objects by a list of ``ObjectId`` (string or ObjectId)
+        with one ``$in`` query, return them in the order of ``oids``,
+        ``None`` for missing ones. ``read`` is the same as in ``find``."""
+        oids = [ObjectId(oid) if oid else None for oid in oids]
+        found = {}
+        cache = cls._cache_
+        missing = set(oid for oid in oids if oid)
+        if cache is not None:
+            for oid in list(missing):
+                obj = cache.get(cls, oid)
+                if obj is not None:
+                    found[oid] = obj
+                    missing.discard(oid)
+        if missing:
+            hydrate = cls._hydrate
+            for d in cls._reader(read).find(
+                    {'_id': {'$in': list(missing)}}):
+                obj = found[d['_id']] = hydrate(d)
+                if cache is not None:
+                    cache.put(obj)
+        return [found.get(oid) for oid in oids]
 
     @classmethod
+    def loader(cls):
+        """Return a ``Loader`` coalescing lookups of this model."""
+        return Loader(cls)
+
+    @classmethod
+    @_instrumented('delete_by_id')
     def delete_by_id(cls, oid):
         """Delete a document from collection by its ``ObjectId``,
         ``oid`` can be string or ObjectId"""
         if oid:
-            cls.collection.remove(ObjectId(oid))
+            oid = ObjectId(oid)
+            cls.collection.delete_one({'_id': oid})
+            cls._pin_primary()
+            if cls._cache_ is not None:
+                cls._cache_.invalidate(cls, oid)
 
     @classmethod
     def from_dict(cls, d):
@@ -186,23 +866,315 @@ class Model(ObjectDict):
         return cls(**d)
 
     @classmethod
-    def from_cursor(cls, cursor):
-        """Build model object from a pymongo cursor."""
-        for d in cursor:
-            yield cls(**d)
+    def _hydrate(cls, d):
+        """Build model object from a decoded document with a single copy.
+
+        Unlike ``cls(**d)`` the document is not unpacked into keyword
+        arguments first, ``__init__`` is not called and callable defaults
+        are only called for missing keys."""
+        instance = dict.__new__(cls)
+        dict.update(instance, cls._default_values_)
+        dict.update(instance, d)
+        for k, factory in cls._default_factories_:
+            if k not in d:
+                dict.__setitem__(instance, k, factory())
+        instance.__dict__['_changed_'] = ()
+        return instance
+
+    @staticmethod
+    def _projection(fields):
+        """Return ``fields`` (list of names or a projection) as a projection
+        dict."""
+        if isinstance(fields, dict):
+            return dict(fields)
+        return dict((name, 1) for name in fields)
+
+    @classmethod
+    def _hydrator(cls, fields=None, lazy=False):
+        """Return the function building model objects from documents found
+        with projection ``fields``, defaults are only set for projected
+        keys."""
+        if fields is None:
+            return cls._hydrate
+
+        projection = cls._projection(fields)
+        include = any(v for k, v in projection.items() if k != '_id')
+        values = dict((k, v) for k, v in cls._default_values_.items()
+                      if projection.get(k, not include))
+        factories = tuple((k, f) for k, f in cls._default_factories_
+                          if projection.get(k, not include))
+
+        def hydrate(d):
+            instance = dict.__new__(cls)
+            dict.update(instance, values)
+            dict.update(instance, d)
+            for k, factory in factories:
+                if k not in d:
+                    dict.__setitem__(instance, k, factory())
+            instance.__dict__.update(_changed_=(), _projection_=projection,
+                                     _lazy_=lazy)
+            return instance
+        return hydrate
+
+    @classmethod
+    def from_cursor(cls, cursor, fields=None, lazy=False):
+        """Build model object from a pymongo cursor, ``fields`` is the
+        projection the cursor was opened with, if any."""
+        return cls._hydrate_cursor(cursor, 'find', fields, lazy)
+
+    @classmethod
+    def _hydrate_cursor(cls, cursor, op, fields=None, lazy=False):
+        """Same as ``from_cursor``, recorded as ``op`` in the metrics."""
+        hydrate = cls._hydrator(fields, lazy)
+        metrics = _metrics
+        if metrics is None or getattr(_instrumenting, 'active', False):
+            for d in cursor:
+                yield hydrate(d)
+            return
+
+        # time spent fetching and hydrating, not in the consumer
+        cursor = iter(cursor)
+        elapsed, docs, nbytes = 0.0, 0, 0
+        try:
+            while True:
+                start = _timer()
+                try:
+                    d = next(cursor)
+                except StopIteration:
+                    break
+                if metrics.measure_bytes:
+                    nbytes += len(BSON.encode(d))
+                obj = hydrate(d)
+                elapsed += _timer() - start
+                docs += 1
+                yield obj
+        finally:
+            metrics.record(cls, op, elapsed, docs=docs, nbytes=nbytes)
 
     @classmethod
     def find(cls, *args, **kwargs):
-        """Same as ``collection.find``, returns model object instead of dict."""
-        return cls.from_cursor(cls.collection.find(*args, **kwargs))
+        """Same as ``collection.find``, returns model object instead of dict.
+
+        ``fields`` (list of names or a projection dict) is projected on the
+        server, the partial model objects only get defaults of the projected
+        keys, and their ``save()`` only updates changed keys. With ``lazy``
+        other keys are fetched on first attribute access to one of them.
+
+        ``read`` (a mode name such as ``'secondary'`` or a pymongo read
+        preference) routes this read, see ``read_from()``."""
+        fields = kwargs.pop('fields', None)
+        lazy = kwargs.pop('lazy', False)
+        read = kwargs.pop('read', None)
+        if fields is not None:
+            kwargs['projection'] = cls._projection(fields)
+        return cls.from_cursor(cls._reader(read).find(*args, **kwargs),
+                               fields, lazy)
+
+    @classmethod
+    def aggregate(cls, pipeline, as_model=False, batch_size=None,
+                  allow_disk_use=False, read=None, **kwargs):
+        """Run the aggregation ``pipeline`` (list of stages or a ``Pipeline``)
+        on the server, return a cursor streaming the resulting dicts.
+
+        With ``as_model`` the results are built as objects of this model, or
+        of the given model class, with its defaults applied. ``read`` is the
+        same as in ``find``, other keyword arguments are passed to
+        ``collection.aggregate``."""
+        if batch_size is not None:
+            kwargs['batchSize'] = batch_size
+        if allow_disk_use:
+            kwargs['allowDiskUse'] = True
+        cursor = cls._reader(read).aggregate(list(pipeline), **kwargs)
+        if not as_model:
+            return cursor
+        model_cls = cls if as_model is True else as_model
+        return model_cls._hydrate_cursor(cursor, 'aggregate')
+
+    @classmethod
+    def paginate(cls, query=None, sort_key='_id', page_size=20, after=None,
+                 before=None, direction=1, fields=None, read=None):
+        """Return a ``Page`` of at most ``page_size`` model objects matching
+        ``query``, sorted by ``sort_key`` and then ``_id`` as tiebreaker, both
+        in ``direction`` (1 or -1).
+
+        Pages are sought by range instead of skipped to, so every page costs
+        the same given an index on ``sort_key`` and ``_id``. Pass the
+        ``next_token`` of a page as ``after`` for the following page, its
+        ``prev_token`` as ``before`` for the preceding one. ``sort_key``
+        should be set on every document, it is added to ``fields`` along
+        with ``_id``. ``read`` is the same as in ``find``."""
+        spec, sort = cls._seek(query, sort_key, after, before, direction)
+        objs = list(cls.find(spec, sort=sort, limit=page_size + 1,
+                             fields=cls._page_fields(fields, sort_key),
+                             read=read))
+        return Page.build(objs, page_size, sort_key, direction, after,
+                          before)
+
+    @classmethod
+    def _page_fields(cls, fields, sort_key):
+        """Return ``fields`` of ``paginate`` as a projection keeping the keys
+        its tokens are made of."""
+        if fields is None:
+            return None
+        projection = cls._projection(fields)
+        include = any(v for k, v in projection.items() if k != '_id')
+        for key in (sort_key, '_id'):
+            if not projection.get(key, 1):
+                del projection[key]
+            elif include and key != '_id':
+                projection[key] = 1
+        return projection
+
+    @staticmethod
+    def _seek(query, sort_key, after, before, direction):
+        """Return the query and sort of ``paginate``, the sort is reversed
+        to page backward from ``before``."""
+        token = after if before is None else before
+        order = direction if before is None else -direction
+        spec = dict(query or {})
+        if token is not None:
+            value, oid = Page.decode(token, sort_key, direction)
+            op = '$gt' if order > 0 else '$lt'
+            if sort_key == '_id':
+                seek = {'_id': {op: oid}}
+            else:
+                seek = {'$or': [{sort_key: {op: value}},
+                                {sort_key: value, '_id': {op: oid}}]}
+            spec = {'$and': [spec, seek]} if spec else seek
+        sort = [(sort_key, order)]
+        if sort_key != '_id':
+            sort.append(('_id', order))
+        return spec, sort
+
+    @classmethod
+    def pipeline(cls):
+        """Return an empty ``Pipeline`` aggregating this model."""
+        return Pipeline(cls)
+
+    @classmethod
+    def compact_class(cls):
+        """Return the ``CompactModel`` class of this model, keys of
+        ``_defaults_`` and ``_fields_`` are stored in its slots."""
+        compact_cls = vars(cls).get('_compact_class_')
+        if compact_cls is None:
+            reserved = set(dir(CompactModel))
+            fields = ['_id'] + sorted(set(cls._default_values_) |
+                                      set(k for k, _ in
+                                          cls._default_factories_) |
+                                      set(cls._fields_))
+            slots = tuple(k for k in fields if k not in reserved and
+                          _IDENTIFIER.match(k))
+            compact_cls = type('Compact' + cls.__name__, (CompactModel,), {
+                '__slots__': slots,
+                '_model_': cls,
+                '_slot_set_': frozenset(slots),
+            })
+            type.__setattr__(cls, '_compact_class_', compact_cls)
+        return compact_cls
+
+    def to_compact(self):
+        """Return a ``CompactModel`` copy of this model object."""
+        return self.compact_class().from_dict(self)
+
+    @classmethod
+    def find_compact(cls, *args, **kwargs):
+        """Same as ``find``, returns ``CompactModel`` objects built straight
+        from the documents."""
+        from_dict = cls.compact_class()._from_document
+        read = kwargs.pop('read', None)
+        for d in cls._reader(read).find(*args, **kwargs):
+            yield from_dict(d)
 
     @classmethod
+    @_instrumented('find_columns')
+    def find_columns(cls, query=None, fields=(), batch_size=1000,
+                     numpy=False, read=None, **kwargs):
+        """Find documents matching ``query`` into one ``Column`` per field
+        of ``fields`` (dotted names allowed) without building model objects,
+        return a dict of field name and ``Column``.
+
+        Missing fields are filled with their ``_defaults_``, ``None`` and
+        missing values without default are masked. With ``numpy`` the
+        columns hold NumPy arrays, which must be installed. ``read`` is the
+        same as in ``find``."""
+        paths = [(field, field.split('.')) for field in fields]
+        projection = dict((field, 1) for field in fields)
+        projection.setdefault('_id', 0)
+        columns = OrderedDict()
+        for field in fields:
+            default = cls._defaults_fill(field)
+            columns[field] = Column(field, default)
+
+        cursor = cls._reader(read).find(query or {}, projection=projection,
+                                        batch_size=batch_size, **kwargs)
+        for d in cursor:
+            for field, path in paths:
+                columns[field].append(_get_path(d, path))
+        if numpy:
+            for column in columns.values():
+                column.to_numpy()
+        return columns
+
+    @classmethod
+    def _defaults_fill(cls, field):
+        """Return the default of ``field`` as a callable or ``None``."""
+        if field in cls._default_values_:
+            value = cls._default_values_[field]
+            return lambda: value
+        return dict(cls._default_factories_).get(field)
+
+    @classmethod
+    def only(cls, *fields):
+        """Return a ``Projection`` finding partial model objects with only
+        ``fields`` (and ``_id``)."""
+        return Projection(cls, cls._projection(fields))
+
+    @classmethod
+    def exclude(cls, *fields):
+        """Return a ``Projection`` finding partial model objects without
+        ``fields``."""
+        return Projection(cls, dict((name, 0) for name in fields))
+
+    @staticmethod
+    def _id_spec(args, kwargs):
+        """Return the ``ObjectId`` if arguments of ``find_one`` only look up
+        by ``_id``."""
+        if len(args) == 1 and not kwargs:
+            spec = args[0]
+            if isinstance(spec, dict) and list(spec) == ['_id']:
+                spec = spec['_id']
+            if isinstance(spec, ObjectId):
+                return spec
+
+    @classmethod
+    @_instrumented('find_one')
     def find_one(cls, *args, **kwargs):
         """Same as ``collection.find_one``, returns model object instead of
-        dict."""
-        d = cls.collection.find_one(*args, **kwargs)
+        dict. ``fields``, ``lazy`` and ``read`` are the same as in
+        ``find``."""
+        if kwargs.get('fields') is not None:
+            if args and not isinstance(args[0], (dict, type(None))):
+                args = ({'_id': args[0]},) + args[1:]
+            for obj in cls.find(*args, limit=1, **kwargs):
+                return obj
+            return None
+        kwargs.pop('fields', None)
+        kwargs.pop('lazy', None)
+        read = kwargs.pop('read', None)
+        cache = cls._cache_
+        if len(args) > 1 or kwargs.get('projection') is not None:
+            # projected documents are partial, never cached
+            cache = None
+        if cache is not None:
+            oid = cls._id_spec(args, kwargs)
+            if oid is not None:
+                return cls.by_id(oid, read=read)
+        d = cls._reader(read).find_one(*args, **kwargs)
         if d:
-            return cls(**d)
+            obj = cls._hydrate(d)
+            if cache is not None:
+                cache.put(obj)
+            return obj
 
     @property
     def id(self):
@@ -210,15 +1182,22 @@ class Model(ObjectDict):
         if '_id' in self:
             return str(self._id)
 
+    @_instrumented('reload')
     def reload(self, d=None):
         """Reload model from given dict or database."""
         if d:
-            self.clear()
-            self.update(d)
+            dict.clear(self)
+            dict.update(self, d)
+            self.__dict__['_changed_'] = None
+            self.__dict__.pop('_projection_', None)
         elif self.id:
-            new_dict = self.by_id(self._id)
-            self.clear()
-            self.update(new_dict)
+            new_dict = self._hydrate(self._reader().find_one(self._id))
+            dict.clear(self)
+            dict.update(self, new_dict)
+            self.__dict__['_changed_'] = ()
+            self.__dict__.pop('_projection_', None)
+            if self._cache_ is not None:
+                self._cache_.put(self)
         else:
             # should I raise an exception here?
             # Like "Model must be saved first."
@@ -228,59 +1207,1214 @@ class Model(ObjectDict):
         """Hook after save."""
         pass
 
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            if self._lazy_ and self._projection_ is not None:
+                self.load_missing()
+                if name in self:
+                    return self[name]
+            raise AttributeError(name)
+
+    @property
+    def is_partial(self):
+        """Whether only some fields of the document are loaded."""
+        return self._projection_ is not None
+
+    def load_missing(self):
+        """Fetch the fields not loaded by a projection, keys changed since
+        load are kept."""
+        projection = self._projection_
+        if projection is None or not self.id:
+            return
+        include = any(v for k, v in projection.items() if k != '_id')
+        if include:
+            missing = dict((k, 0) for k in projection if k != '_id')
+        else:
+            missing = dict((k, 1) for k, v in projection.items() if not v)
+        d = self._reader().find_one(self._id, projection=missing) or {}
+        changed = self._changed_ or ()
+        for k, v in self._hydrate(d).items():
+            if k not in self and k not in changed:
+                dict.__setitem__(self, k, v)
+        self.__dict__.pop('_projection_', None)
+
+    def _update_spec(self):
+        """Return the ``$set``/``$unset`` update of the changed keys, or
+        ``None`` if the whole document has to be written."""
+        changed = self._changed_
+        if self._projection_ is not None and (
+                changed is None or '_id' in changed):
+            raise PartialModelError('Partial %s can not be saved as whole, '
+                                    'load_missing() first.' %
+                                    self.__class__.__name__)
+        if changed is None or '_id' in changed:
+            return None
+        spec, unset = {}, {}
+        for k in changed:
+            if k in self:
+                spec[k] = self[k]
+            else:
+                unset[k] = ''
+        update = {}
+        if spec:
+            update['$set'] = spec
+        if unset:
+            update['$unset'] = unset
+        return update
+
+    def _save_op(self):
+        """Return the name and arguments of the collection method saving
+        this model, or ``None`` if nothing changed. ``_id`` is assigned to
+        new documents."""
+        if '_id' not in self:
+            if self._projection_ is not None:
+                raise PartialModelError('Partial %s without _id can not be '
+                                        'saved.' % self.__class__.__name__)
+            dict.__setitem__(self, '_id', ObjectId())
+            return 'insert_one', (self,)
+        update = self._update_spec()
+        if update is None:
+            return 'replace_one', ({'_id': self._id}, self, True)
+        if update:
+            return 'update_one', ({'_id': self._id}, update)
+
+    @_instrumented('save')
     def save(self):
-        """Save model object to database."""
-        d = dict(self)
-        old_dict = d.copy()
-        _id = self.collection.save(d)
-        self._id = _id
+        """Save model object to database.
+
+        New documents are inserted, loaded documents only send the keys
+        changed since load with ``$set``/``$unset``. Reads of this thread
+        go to the primary for ``_read_your_writes_`` seconds after."""
+        old_dict = dict(self)
+        op = self._save_op()
+        if op:
+            method, args = op
+            try:
+                getattr(self.collection, method)(*args)
+            except Exception:
+                # a retried save inserts again
+                if '_id' not in old_dict:
+                    dict.pop(self, '_id', None)
+                raise
+            self._pin_primary()
+        self._saved([self])
         self.on_save(old_dict)
         return self._id
 
+    @classmethod
+    def on_save_many(cls, objs, old_dicts):
+        """Hook after ``save_many`` wrote a batch, calls ``on_save`` of each
+        model object by default."""
+        for obj, old_dict in zip(objs, old_dicts):
+            obj.on_save(old_dict)
+
+    @classmethod
+    @_instrumented('save_many')
+    def save_many(cls, objs, batch_size=1000, ordered=True):
+        """Save model objects with one ``bulk_write`` per ``batch_size``
+        objects, return the list of their ``_id``."""
+        ids = []
+        for batch in _chunked(objs, batch_size):
+            old_dicts, requests, sent = [], [], []
+            for obj in batch:
+                old_dicts.append(dict(obj))
+                op = obj._save_op()
+                if op:
+                    method, args = op
+                    sent.append(obj)
+                    requests.append(_BULK_OPS[method](*args))
+            if requests:
+                try:
+                    cls.collection.bulk_write(requests, ordered=ordered)
+                except Exception as e:
+                    batch, old_dicts = cls._written(e, batch, old_dicts,
+                                                    sent, ordered)
+                    cls._saved(batch)
+                    cls.on_save_many(batch, old_dicts)
+                    raise
+                cls._pin_primary()
+            cls._saved(batch)
+            ids.extend(obj._id for obj in batch)
+            cls.on_save_many(batch, old_dicts)
+        return ids
+
+    @classmethod
+    def _written(cls, error, batch, old_dicts, sent, ordered):
+        """Return the model objects of a ``save_many`` batch written before
+        ``error`` and their old dicts, the ``_id`` generated for the others
+        is dropped so that they are inserted when saved again."""
+        unwritten = _unwritten(error, sent, ordered)
+        objs, dicts = [], []
+        for obj, old_dict in zip(batch, old_dicts):
+            if id(obj) not in unwritten:
+                objs.append(obj)
+                dicts.append(old_dict)
+            elif '_id' not in old_dict:
+                dict.pop(obj, '_id', None)
+        return objs, dicts
+
+    @classmethod
+    def _saved(cls, objs):
+        """Mark saved model objects unchanged and cache the whole ones."""
+        cache = cls._cache_
+        for obj in objs:
+            obj.__dict__['_changed_'] = ()
+            if cache is None:
+                continue
+            if obj._projection_ is None:
+                cache.put(obj)
+            else:
+                cache.invalidate(cls, obj._id)
+
     def on_delete(self, deleted_obj):
         """Hook after delete successful."""
         pass
 
+    @_instrumented('delete')
     def delete(self):
         """Remove from database."""
         if not self.id:
             return
-        self.collection.remove({'_id': self._id})
+        self.collection.delete_one({'_id': self._id})
+        self._pin_primary()
+        if self._cache_ is not None:
+            self._cache_.invalidate(self.__class__, self._id)
         self.on_delete(self)
 
+    @classmethod
+    def on_delete_many(cls, objs):
+        """Hook after ``delete_many`` removed a batch, calls ``on_delete`` of
+        each model object by default."""
+        for obj in objs:
+            obj.on_delete(obj)
+
+    @classmethod
+    @_instrumented('delete_many')
+    def delete_many(cls, objs, batch_size=1000):
+        """Remove model objects with one ``delete_many`` per ``batch_size``
+        objects, unsaved ones are skipped."""
+        for batch in _chunked(objs, batch_size):
+            batch = [obj for obj in batch if obj.id]
+            if batch:
+                cls.collection.delete_many(
+                    {'_id': {'$in': [obj._id for obj in batch]}})
+                cls._pin_primary()
+                if cls._cache_ is not None:
+                    for obj in batch:
+                        cls._cache_.invalidate(cls, obj._id)
+                cls.on_delete_many(batch)
+
+    @classmethod
+    def export(cls, path, query=None, format='bson', compress=False,
+               batch_size=1000, after=None, progress=None):
+        """Stream documents matching ``query`` to file ``path`` in ``_id``
+        order, return the number of documents written and the last
+        ``_id``.
+
+        ``format`` is ``'bson'`` (raw documents, not decoded at all) or
+        ``'json'`` (one canonical Extended JSON document per line). With
+        ``compress`` (or a ``.gz`` path) the file is gzipped. Export resumes
+        after the ``_id`` given as ``after``. ``progress`` is called with
+        the count and the last ``_id`` after every ``batch_size``
+        documents, the checkpoint to resume from."""
+        query = dict(query or {})
+        if after is not None:
+            query = {'$and': [query, {'_id': {'$gt': after}}]}
+        collection = cls.collection
+        if format == 'bson':
+            collection = collection.with_options(codec_options=CodecOptions(
+                document_class=RawBSONDocument))
+        cursor = collection.find(query, sort=[('_id', 1)],
+                                 batch_size=batch_size)
+
+        count, last = 0, None
+        with _open_dump(path, 'wb', compress) as f:
+            for doc in cursor:
+                if format == 'bson':
+                    f.write(doc.raw)
+                else:
+                    f.write(json_util.dumps(
+                        doc, json_options=json_util.CANONICAL_JSON_OPTIONS
+                    ).encode('utf-8') + b'\n')
+                count += 1
+                last = doc
+                if progress and count % batch_size == 0:
+                    progress(count, last['_id'])
+        last_id = last['_id'] if last is not None else after
+        if progress and count % batch_size:
+            progress(count, last_id)
+        return count, last_id
+
+    @classmethod
+    def split_ids(cls, query=None, num=4, oversample=10):
+        """Return up to ``num - 1`` ``_id`` split points of the documents
+        matching ``query``, estimated from a ``$sample`` of them."""
+        if num < 2:
+            return []
+        sample = sorted(d['_id'] for d in cls.collection.aggregate([
+            {'$match': query or {}},
+            {'$sample': {'size': num * oversample}},
+            {'$project': {'_id': 1}}]))
+        step = len(sample) / float(num)
+        points = []
+        for i in range(1, num):
+            point = sample[int(i * step)] if sample else None
+            if point is not None and (not points or point > points[-1]):
+                points.append(point)
+        return points
+
+    @classmethod
+    def parallel_scan(cls, query=None, fn=None, workers=4, partitions=None,
+                      ordered=False, processes=False, fields=None):
+        """Scan the documents matching ``query`` with ``workers`` threads
+        (or processes), each scanning an ``_id`` range with its own cursor.
+        Yield ``fn(obj)`` of every model object, or the objects if ``fn`` is
+        ``None``.
+
+        The range is split into ``partitions`` (default ``workers * 4``)
+        with ``split_ids()``. Results of a range are yielded once it is
+        scanned, in ``_id`` order of the ranges if ``ordered``. With
+        ``processes`` the model class and ``fn`` must be picklable."""
+        points = cls.split_ids(query, partitions or workers * 4)
+        bounds = [None] + points + [None]
+        tasks = [(cls, query, bounds[i], bounds[i + 1], fn, fields)
+                 for i in range(len(bounds) - 1)]
+        pool = (Pool if processes else ThreadPool)(workers)
+        try:
+            scan = pool.imap if ordered else pool.imap_unordered
+            for results in scan(_scan_range, tasks):
+                for result in results:
+                    yield result
+        finally:
+            pool.terminate()
+
+    @classmethod
+    def on_import(cls, count):
+        """Hook after ``import_`` inserted ``count`` documents."""
+        pass
+
+    @classmethod
+    def import_(cls, path, format='bson', compress=False, batch_size=1000,
+                after=None, hooks=False, ordered=True, progress=None):
+        """Insert documents from a file written by ``export`` with one
+        ``insert_many`` per ``batch_size`` documents, return the number of
+        documents inserted and the last ``_id``.
+
+        Documents are not decoded into model objects unless ``hooks`` is
+        set, then ``on_save`` of each model object is called. ``on_import``
+        is called once at the end. Documents up to the ``_id`` given as
+        ``after`` are skipped, ``progress`` is the same as in ``export``."""
+        count, last_id = 0, after
+        with _open_dump(path, 'rb', compress) as f:
+            if format == 'bson':
+                docs = decode_file_iter(f, CodecOptions(
+                    document_class=RawBSONDocument))
+            else:
+                docs = (json_util.loads(line.decode('utf-8')) for line in f
+                        if line.strip())
+            if after is not None:
+                docs = _skip_until(docs, after)
+            if hooks:
+                docs = (cls._hydrate(doc) for doc in docs)
+
+            try:
+                for batch in _chunked(docs, batch_size):
+                    cls.collection.insert_many(batch, ordered=ordered)
+                    count += len(batch)
+                    last_id = batch[-1]['_id']
+                    if hooks:
+                        for obj in batch:
+                            obj.on_save(dict(obj))
+                    if progress:
+                        progress(count, last_id)
+            finally:
+                if count:
+                    cls.on_import(count)
+        return count, last_id
+
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+class CompactModel(object):
+    """Memory compact, read-oriented representation of a model object
+    returned by ``Model.to_compact`` and ``Model.find_compact``.
+
+    Known keys are stored in slots instead of a per-instance hash table and
+    read as plain attributes, other keys go to an overflow dict. Convert
+    back with ``to_model()`` before saving."""
+    __slots__ = ('_extra_',)
+    _model_ = None
+    _slot_set_ = frozenset()
+
+    @classmethod
+    def from_dict(cls, d):
+        """Build compact object from dict ``d``, no defaults are set."""
+        obj = object.__new__(cls)
+        slot_set = cls._slot_set_
+        extra = None
+        for k, v in d.items():
+            if k in slot_set:
+                setattr(obj, k, v)
+            elif extra is None:
+                extra = {k: v}
+            else:
+                extra[k] = v
+        obj._extra_ = extra
+        return obj
+
+    @classmethod
+    def _from_document(cls, d):
+        """Build compact object from a decoded document with defaults of the
+        model."""
+        model = cls._model_
+        for k, v in model._default_values_.items():
+            if k not in d:
+                d[k] = v
+        for k, factory in model._default_factories_:
+            if k not in d:
+                d[k] = factory()
+        return cls.from_dict(d)
+
+    def __getattr__(self, name):
+        if name == '_extra_':
+            raise AttributeError(name)
+        extra = self._extra_
+        if extra is not None and name in extra:
+            return extra[name]
+        raise AttributeError(name)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        """Return the keys and values as a dict."""
+        d = {}
+        for k in self.__slots__:
+            try:
+                d[k] = getattr(self, k)
+            except AttributeError:
+                pass
+        if self._extra_:
+            d.update(self._extra_)
+        return d
+
+    def to_model(self):
+        """Return the model object, saving it only updates keys changed
+        after the conversion."""
+        return self._model_._hydrate(self.to_dict())
+
+    def __eq__(self, other):
+        if isinstance(other, CompactModel):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.to_dict())
+
+
+class Column(object):
+    """Values of one field found by ``Model.find_columns``.
+
+    ``values`` is an ``array`` of bool, int or float values if all values
+    of the field share that type, a list otherwise. ``mask`` is an
+    ``array`` with 1 for present values and 0 for nulls, whose slot in
+    ``values`` is filled with 0."""
+    typecodes = ((bool, 'b'), (int, 'q'), (float, 'd'))
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+        self.values = []
+        self.mask = array('b')
+        self._type = None
+        self._typed = None  # undecided until the first value
+
+    def append(self, value):
+        """Append ``value``, ``None`` is filled with the default or masked."""
+        if value is None and self.default is not None:
+            value = self.default()
+        if value is None:
+            self.values.append(0 if self._typed else None)
+            self.mask.append(0)
+            return
+
+        if self._typed is None:
+            self._decide(type(value))
+        if self._typed:
+            if type(value) is self._type:
+                try:
+                    self.values.append(value)
+                    self.mask.append(1)
+                    return
+                except OverflowError:
+                    pass
+            self.values = [v if present else None
+                           for v, present in zip(self.values, self.mask)]
+            self._typed = False
+        self.values.append(value)
+        self.mask.append(1)
+
+    def _decide(self, value_type):
+        """Store values in a typed array if ``value_type`` allows."""
+        self._typed = False
+        for klass, typecode in self.typecodes:
+            if value_type is klass:
+                self.values = array(typecode, [0] * len(self.values))
+                self._type = klass
+                self._typed = True
+
+    def to_numpy(self):
+        """Convert ``values`` and ``mask`` to NumPy arrays."""
+        import numpy
+        if self._typed and self._type is bool:
+            self.values = numpy.array(self.values, dtype=bool)
+        elif self._typed:
+            self.values = numpy.frombuffer(self.values,
+                                           dtype=self.values.typecode)
+        else:
+            self.values = numpy.array(self.values, dtype=object)
+        self.mask = numpy.frombuffer(self.mask, dtype='b').astype(bool)
+
+    def __len__(self):
+        return len(self.mask)
+
+    def __getitem__(self, index):
+        return self.values[index] if self.mask[index] else None
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class IdentityMap(object):
+    """LRU cache of model objects keyed by ``(database, collection, _id)``,
+    set it as ``_cache_`` of models to serve ``by_id`` from memory.
+
+    Entries expire after ``ttl`` seconds if given. With ``copy`` a shallow
+    copy is returned instead of the cached object. With ``scoped`` objects
+    are only cached inside ``scope()`` blocks.
+
+    example::
+
+        >> users = IdentityMap(max_size=10000, ttl=60)
+        >> @c.register_model
+        >> class User(Model):
+        >>     _database_ = 'test'
+        >>     _collection_ = 'users'
+        >>     _cache_ = users
+        >> User.by_id(oid) is User.by_id(oid)
+        True
+    """
+    def __init__(self, max_size=10000, ttl=None, copy=False, scoped=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.copy = copy
+        self.scoped = scoped
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._local = threading.local()
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def scope(self):
+        """Cache model objects in a map private to this block and thread,
+        e.g. per request. Nested scopes share the outer map."""
+        if getattr(self._local, 'entries', None) is not None:
+            yield
+            return
+        self._local.entries = OrderedDict()
+        try:
+            yield
+        finally:
+            self._local.entries = None
+
+    def _current(self):
+        entries = getattr(self._local, 'entries', None)
+        if entries is None and not self.scoped:
+            entries = self._entries
+        return entries
+
+    @staticmethod
+    def _key(model_cls, oid):
+        return model_cls._database_, model_cls._collection_, oid
+
+    def get(self, model_cls, oid):
+        """Return cached object of ``model_cls`` by ``oid`` or ``None``."""
+        entries = self._current()
+        if entries is None:
+            return None
+        key = self._key(model_cls, oid)
+        with self._lock:
+            obj, expires = entries.pop(key, (None, None))
+            if obj is not None and type(obj) is model_cls and (
+                    expires is None or expires > time.time()):
+                entries[key] = obj, expires
+                self.hits += 1
+                return obj._hydrate(obj) if self.copy else obj
+            self.misses += 1
+
+    def put(self, obj):
+        """Cache model object ``obj``."""
+        entries = self._current()
+        if entries is None:
+            return
+        if self.copy:
+            obj = obj._hydrate(obj)
+        expires = time.time() + self.ttl if self.ttl else None
+        key = self._key(obj.__class__, obj['_id'])
+        with self._lock:
+            entries.pop(key, None)
+            entries[key] = obj, expires
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+
+    def invalidate(self, model_cls, oid):
+        """Drop cached object of ``model_cls`` by ``oid``."""
+        key = self._key(model_cls, oid)
+        with self._lock:
+            self._entries.pop(key, None)
+            entries = getattr(self._local, 'entries', None)
+            if entries is not None:
+                entries.pop(key, None)
+
+    def invalidate_collection(self, model_cls):
+        """Drop all cached objects of the collection of ``model_cls``."""
+        prefix = model_cls._database_, model_cls._collection_
+        with self._lock:
+            for key in [k for k in self._entries if k[:2] == prefix]:
+                del self._entries[key]
+
+    def refresh(self, model_cls, d):
+        """Replace the cached object of ``model_cls`` with the ``_id`` of
+        document ``d`` by one built from ``d``, if it is cached."""
+        key = self._key(model_cls, d['_id'])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                obj, expires = entry
+                self._entries[key] = type(obj)._hydrate(d), expires
+
+    def clear(self):
+        """Drop all cached objects and reset statistics."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Return hits, misses and size of the cache."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._current() or ())}
+
+
+class Watcher(object):
+    """Follows the change streams of registered models in background
+    threads, requires a replica set and pymongo 3.8+.
+
+    Changes by any process invalidate the entries of ``_cache_``, or with
+    ``patch`` replace updated entries by the full document looked up by the
+    server. Callbacks subscribed with ``subscribe()`` receive the model
+    class and each change. With ``resume_file`` the resume tokens are saved
+    every ``save_interval`` seconds and on ``stop()``, so a restarted
+    watcher continues where it stopped. If that is no longer possible the
+    cache of the collection is dropped.
+
+    Failed streams are retried after ``retry_wait`` seconds, doubled up to
+    ``max_retry_wait`` while they keep failing. Errors retrying can not fix,
+    such as a standalone server or missing privileges, stop following the
+    model.
+
+    example::
+
+        >> watcher = Watcher([User, Counter], patch=True,
+        >>                   resume_file='/var/lib/app/tokens.json')
+        >> watcher.subscribe(lambda model_cls, change: print(change),
+        >>                   User, operations=['delete'])
+        >> watcher.start()
+    """
+    # operations making every cached object of the collection stale
+    invalidating = frozenset(['drop', 'rename', 'dropDatabase', 'invalidate'])
+    # error codes of streams which can not be followed: Unauthorized,
+    # AuthenticationFailed, unknown $changeStream stage, not a replica set
+    fatal_codes = frozenset([13, 18, 40324, 40573])
+
+    def __init__(self, models=(), patch=False, resume_file=None,
+                 save_interval=1.0, max_await_time_ms=1000, retry_wait=1.0,
+                 max_retry_wait=60.0):
+        self.models = list(models)
+        self.patch = patch
+        self.resume_file = resume_file
+        self.save_interval = save_interval
+        self.max_await_time_ms = max_await_time_ms
+        self.retry_wait = retry_wait
+        self.max_retry_wait = max_retry_wait
+        self.tokens = self._load_tokens()
+        self._subscribers = []
+        self._threads = []
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._saved_at = time.time()
+
+    @staticmethod
+    def _key(model_cls):
+        return '%s.%s' % (model_cls._database_, model_cls._collection_)
+
+    def watch(self, model_cls):
+        """Also follow changes of ``model_cls``, before ``start()``."""
+        self.models.append(model_cls)
+        return model_cls
+
+    def subscribe(self, callback, model_cls=None, operations=None):
+        """Call ``callback(model_cls, change)`` for changes of ``model_cls``
+        (of all models if ``None``) whose ``operationType`` is in
+        ``operations`` (all if ``None``). Return ``callback``."""
+        operations = frozenset(operations) if operations else None
+        with self._lock:
+            self._subscribers.append((callback, model_cls, operations))
+        return callback
+
+    def unsubscribe(self, callback):
+        """Stop calling ``callback``."""
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers
+                                 if s[0] is not callback]
+
+    def handle(self, model_cls, change):
+        """Apply ``change`` of ``model_cls`` to its cache and call the
+        subscribers."""
+        op = change['operationType']
+        cache = model_cls._cache_
+        if cache is not None:
+            if op in self.invalidating:
+                cache.invalidate_collection(model_cls)
+            elif 'documentKey' in change:
+                full = change.get('fullDocument')
+                if self.patch and full and op != 'delete':
+                    cache.refresh(model_cls, full)
+                else:
+                    cache.invalidate(model_cls, change['documentKey']['_id'])
+        for callback, cls, operations in list(self._subscribers):
+            if cls is not None and cls is not model_cls:
+                continue
+            if operations is not None and op not in operations:
+                continue
+            try:
+                callback(model_cls, change)
+            except Exception:
+                logging.exception('Watcher callback %r failed' % callback)
+
+    def start(self):
+        """Start one daemon thread per watched model."""
+        self._stopped.clear()
+        for model_cls in self.models:
+            thread = threading.Thread(target=self._follow, args=(model_cls,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        """Stop the threads and save the resume tokens."""
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self.save_tokens()
+
+    def _follow(self, model_cls):
+        key = self._key(model_cls)
+        wait = self.retry_wait
+        while not self._stopped.is_set():
+            kwargs = {'max_await_time_ms': self.max_await_time_ms}
+            if self.patch:
+                kwargs['full_document'] = 'updateLookup'
+            if self.tokens.get(key):
+                kwargs['resume_after'] = self.tokens[key]
+            try:
+                with model_cls.collection.watch(**kwargs) as stream:
+                    while not self._stopped.is_set() and stream.alive:
+                        change = stream.try_next()
+                        if change is not None:
+                            self.handle(model_cls, change)
+                        wait = self.retry_wait
+                        self.tokens[key] = stream.resume_token
+                        if time.time() - self._saved_at > \
+                                self.save_interval:
+                            self.save_tokens()
+            except OperationFailure as e:
+                if e.code in self.fatal_codes:
+                    logging.error('Can not follow change stream of %s: %s' %
+                                  (key, e))
+                    return
+                logging.warning('Restarting change stream of %s: %s' % (
+                    key, e))
+                if self.tokens.pop(key, None) is not None and \
+                        model_cls._cache_ is not None:
+                    # e.g. the resume token fell off the oplog
+                    model_cls._cache_.invalidate_collection(model_cls)
+            except PyMongoError:
+                logging.exception('Change stream of %s failed' % key)
+            else:
+                continue
+            self._stopped.wait(wait)
+            wait = min(wait * 2, self.max_retry_wait)
+
+    def _load_tokens(self):
+        if self.resume_file and os.path.exists(self.resume_file):
+            with open(self.resume_file) as f:
+                return json_util.loads(f.read())
+        return {}
+
+    def save_tokens(self):
+        """Write the resume tokens to ``resume_file``, if given."""
+        self._saved_at = time.time()
+        if not self.resume_file:
+            return
+        with self._lock:
+            tmp = self.resume_file + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(json_util.dumps(dict(self.tokens)))
+            os.rename(tmp, self.resume_file)
+
+
+class Loader(object):
+    """Coalesces lookups of a model by id into ``by_ids`` queries, create
+    one per request to batch N+1 patterns.
+
+    ``load()`` queues an id and returns a ``Deferred``, resolving any of
+    them fetches all queued ids at once. Loaded objects are kept for the
+    lifetime of the loader.
+
+    example::
+
+        >> loader = User.loader()
+        >> owners = [loader.load(post.owner_id) for post in posts]
+        >> [owner.get() for owner in owners]  # one query
+    """
+    def __init__(self, model_cls):
+        self.model_cls = model_cls
+        self._queue = []
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def load(self, oid):
+        """Queue ``oid`` (string or ObjectId) for loading."""
+        oid = ObjectId(oid)
+        with self._lock:
+            if oid not in self._loaded:
+                self._queue.append(oid)
+        return Deferred(self, oid)
+
+    def load_many(self, oids):
+        """Queue ``oids`` for loading."""
+        return [self.load(oid) for oid in oids]
+
+    def dispatch(self):
+        """Fetch all queued ids in one query."""
+        with self._lock:
+            queue, self._queue = self._queue, []
+        if queue:
+            objs = self.model_cls.by_ids(queue)
+            with self._lock:
+                self._loaded.update(zip(queue, objs))
+
+    def get(self, oid):
+        """Return loaded model object of ``oid``, dispatching if needed."""
+        if oid not in self._loaded:
+            self.dispatch()
+        return self._loaded.get(oid)
+
+
+class Deferred(object):
+    """Model object to be loaded by a ``Loader``."""
+    __slots__ = ('loader', 'oid')
+
+    def __init__(self, loader, oid):
+        self.loader = loader
+        self.oid = oid
+
+    def get(self):
+        """Return the model object or ``None`` if not found."""
+        return self.loader.get(self.oid)
+
+
+class Projection(object):
+    """Finds partial model objects of ``model_cls`` with ``projection``,
+    returned by ``Model.only`` and ``Model.exclude``.
+
+    example::
+
+        >> for user in User.only('username', 'is_activated').find():
+        >>     print(user.username)
+        >> User.exclude('avatar').lazy().by_id(oid).avatar  # fetched now
+    """
+    def __init__(self, model_cls, projection, lazy=False):
+        self.model_cls = model_cls
+        self.projection = projection
+        self.lazy_load = lazy
+
+    def lazy(self):
+        """Return a ``Projection`` fetching the other fields on first
+        attribute access to one of them."""
+        return Projection(self.model_cls, self.projection, True)
+
+    def find(self, *args, **kwargs):
+        """Same as ``Model.find`` with this projection."""
+        return self.model_cls.find(*args, fields=self.projection,
+                                   lazy=self.lazy_load, **kwargs)
+
+    def find_one(self, *args, **kwargs):
+        """Same as ``Model.find_one`` with this projection."""
+        return self.model_cls.find_one(*args, fields=self.projection,
+                                       lazy=self.lazy_load, **kwargs)
+
+    def by_id(self, oid):
+        """Same as ``Model.by_id`` with this projection."""
+        return self.model_cls.by_id(oid, fields=self.projection,
+                                    lazy=self.lazy_load)
+
+
+class Pipeline(list):
+    """Aggregation pipeline of ``model_cls``, returned by ``Model.pipeline``.
+    Stage helpers append to the pipeline and return it for chaining.
+
+    example::
+
+        >> (User.pipeline()
+        >>  .match(is_activated=True)
+        >>  .lookup(Post, '_id', 'user_id', 'posts')
+        >>  .group('$role', users={'$sum': 1})
+        >>  .aggregate())
+    """
+    def __init__(self, model_cls, stages=()):
+        super(Pipeline, self).__init__(stages)
+        self.model_cls = model_cls
+
+    def stage(self, name, spec):
+        """Append stage ``name`` (e.g. ``'$sort'``) with ``spec``."""
+        self.append({name: spec})
+        return self
+
+    def match(self, query=None, **fields):
+        """Append a ``$match`` of ``query`` and ``fields`` equal to the given
+        values."""
+        spec = dict(query or {})
+        spec.update(fields)
+        return self.stage('$match', spec)
+
+    def group(self, key, **accumulators):
+        """Append a ``$group`` by ``key`` (e.g. ``'$role'``, ``None`` for all
+        documents) computing ``accumulators``."""
+        spec = {'_id': key}
+        spec.update(accumulators)
+        return self.stage('$group', spec)
+
+    def lookup(self, model_cls, local_field, foreign_field='_id',
+               as_field=None):
+        """Append a ``$lookup`` joining documents of the registered
+        ``model_cls`` whose ``foreign_field`` equals ``local_field``, into
+        ``as_field`` (defaults to the collection name)."""
+        if model_cls._database_ != self.model_cls._database_:
+            raise MonguException('%s can not be looked up from database %s' %
+                                 (model_cls.__name__,
+                                  self.model_cls._database_))
+        return self.stage('$lookup', {
+            'from': model_cls._collection_,
+            'localField': local_field,
+            'foreignField': foreign_field,
+            'as': as_field or model_cls._collection_,
+        })
+
+    def aggregate(self, **kwargs):
+        """Run the pipeline, same as ``Model.aggregate``."""
+        return self.model_cls.aggregate(self, **kwargs)
+
+
+class Page(list):
+    """Model objects of one page, returned by ``Model.paginate``.
+
+    ``next_token`` and ``prev_token`` are opaque strings to pass as
+    ``after`` and ``before`` for the adjacent pages, ``None`` at the ends.
+
+    example::
+
+        >> page = User.paginate({'role': 'admin'}, 'created_at')
+        >> page = User.paginate({'role': 'admin'}, 'created_at',
+        >>                      after=page.next_token)
+    """
+    def __init__(self, objs=(), next_token=None, prev_token=None):
+        super(Page, self).__init__(objs)
+        self.next_token = next_token
+        self.prev_token = prev_token
+
+    @classmethod
+    def build(cls, objs, page_size, sort_key, direction, after=None,
+              before=None):
+        """Build the page from ``page_size + 1`` objects found by
+        ``Model.paginate``."""
+        more = len(objs) > page_size
+        del objs[page_size:]
+        if before is not None:
+            objs.reverse()
+            has_next, has_prev = True, more
+        else:
+            has_next, has_prev = more, after is not None
+        page = cls(objs)
+        if objs:
+            path = sort_key.split('.')
+            if has_next:
+                page.next_token = cls.encode(
+                    sort_key, direction, _get_path(objs[-1], path),
+                    objs[-1]._id)
+            if has_prev:
+                page.prev_token = cls.encode(
+                    sort_key, direction, _get_path(objs[0], path),
+                    objs[0]._id)
+        return page
+
+    @staticmethod
+    def encode(sort_key, direction, value, oid):
+        """Return the token of the position ``value`` and ``oid``."""
+        data = json_util.dumps([sort_key, direction, value, oid])
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode(token, sort_key, direction):
+        """Return the sort value and ``_id`` of ``token``, raise
+        ``PageTokenError`` if it is invalid or of another sort."""
+        try:
+            data = base64.urlsafe_b64decode(str(token)).decode('utf-8')
+            key, order, value, oid = json_util.loads(data)
+        except (TypeError, ValueError):
+            raise PageTokenError('Invalid page token %r' % token)
+        if key != sort_key or order != direction:
+            raise PageTokenError('Page token of another sort: %s %s' % (
+                key, order))
+        return value, oid
+
 
 class Counter(Model):
     """Builtin counter model."""
+    _indexes_ = [{'keys': [('name', 1), ('shard', 1)], 'unique': True}]
+    # number of documents of sharded counters by name
+    _shards_ = {}
+
+    @classmethod
+    def shard(cls, name, num):
+        """Spread counter ``name`` over ``num`` documents to reduce write
+        contention, changes go to a random one of them. ``num`` of 1 goes
+        back to a single document, ``set_to()`` it first."""
+        shards = dict(cls._shards_)
+        if num > 1:
+            shards[name] = num
+        else:
+            shards.pop(name, None)
+        cls._shards_ = shards
+
+    @classmethod
+    def _spec(cls, name):
+        """Return the spec of the document to increase counter ``name``."""
+        num = cls._shards_.get(name)
+        if num:
+            return {'name': name, 'shard': random.randrange(num)}
+        return {'name': name}
+
     @classmethod
+    @_instrumented('set_to')
     def set_to(cls, name, num):
-        """Set counter of ``name`` to ``num``."""
+        """Set counter of ``name`` to ``num``.
+
+        All documents of a sharded counter are reset in one ordered
+        ``bulk_write``, which is not atomic: readers may see a total in
+        between and changes made meanwhile may be lost."""
         if num < 0:
             raise CounterValueError('Counter[%s] can not be set to %s' % (
                                     name, num))
+        elif name in cls._shards_:
+            cls.collection.bulk_write([
+                UpdateMany({'name': name, 'shard': {'$ne': 0}},
+                           {'$set': {'seq': 0}}),
+                UpdateOne({'name': name, 'shard': 0},
+                          {'$set': {'seq': num}}, upsert=True),
+            ])
+            return num
         else:
-            counter = cls.collection.find_and_modify(
+            counter = cls.collection.find_one_and_update(
                 {'name': name},
                 {'$set': {'seq': num}},
-                new=True,
+                return_document=ReturnDocument.AFTER,
                 upsert=True
             )
             return counter['seq']
 
     @classmethod
+    @_instrumented('change_by')
     def change_by(cls, name, num):
-        """Change counter of ``name`` by ``num`` (can be negative)."""
-        count = cls.count(name)
-        if count + num < 0:
+        """Change counter of ``name`` by ``num`` (can be negative).
+
+        Done in one conditional update, a decrease only matches when the
+        counter stays non-negative. A decrease of a sharded counter is
+        taken from as many of its documents as needed, and the total is
+        returned with an extra ``count()``."""
+        if name in cls._shards_:
+            if num < 0:
+                cls._take(name, -num)
+            elif num:
+                cls.collection.update_one(cls._spec(name),
+                                          {'$inc': {'seq': num}},
+                                          upsert=True)
+            return cls.count(name, read='primary')
+        if num < 0:
+            spec = {'name': name, 'seq': {'$gte': -num}}
+        else:
+            spec = cls._spec(name)
+        counter = cls.collection.find_one_and_update(
+            spec,
+            {'$inc': {'seq': num}},
+            return_document=ReturnDocument.AFTER,
+            upsert=num >= 0
+        )
+        if counter is None:
             raise CounterValueError('Counter[%s] will be negative '
                                     'after %+d.' % (name, num))
+        return counter['seq']
+
+    @classmethod
+    def _take(cls, name, amount):
+        """Decrease sharded counter ``name`` by ``amount`` taken from its
+        documents with conditional updates, the fullest first. Raise
+        ``CounterValueError`` and give back what was taken if they do not
+        hold enough."""
+        collection = cls.collection
+        if collection.update_one({'name': name, 'seq': {'$gte': amount}},
+                                 {'$inc': {'seq': -amount}}).modified_count:
+            return
+        remaining = amount
+        for d in collection.find({'name': name, 'seq': {'$gt': 0}},
+                                 sort=[('seq', -1)]):
+            while remaining and d and d['seq'] > 0:
+                take = min(remaining, d['seq'])
+                if collection.update_one(
+                        {'_id': d['_id'], 'seq': {'$gte': take}},
+                        {'$inc': {'seq': -take}}).modified_count:
+                    remaining -= take
+                    break
+                # changed concurrently, look again
+                d = collection.find_one({'_id': d['_id']})
+            if not remaining:
+                return
+        if remaining < amount:
+            collection.update_one(cls._spec(name),
+                                  {'$inc': {'seq': amount - remaining}},
+                                  upsert=True)
+        raise CounterValueError('Counter[%s] will be negative after %+d.' %
+                                (name, -amount))
+
+    @classmethod
+    @_instrumented('change_many')
+    def change_many(cls, deltas):
+        """Change counters by the numbers of ``deltas`` (a dict of name and
+        number), increases in one round trip, then decreases guarded like in
+        ``change_by``.
+
+        If some decreases would make their counter negative, the other
+        changes are still made and ``CounterValueError`` is raised with the
+        rejected changes in its ``deltas``. A ``PyMongoError`` gets the names
+        of the changes made before it in its ``applied``."""
+        increases, updates, decreases = [], [], []
+        for name, num in deltas.items():
+            if num < 0:
+                decreases.append((name, num))
+            elif num:
+                increases.append(name)
+                updates.append((cls._spec(name), {'$inc': {'seq': num}}))
+        applied, rejected = [], {}
+        try:
+            if len(updates) == 1:
+                # the usual single change skips the bulk API
+                cls.collection.update_one(*updates[0], upsert=True)
+            elif updates:
+                try:
+                    cls.collection.bulk_write(
+                        [UpdateOne(spec, update, upsert=True)
+                         for spec, update in updates], ordered=False)
+                except BulkWriteError as e:
+                    applied.extend(_bulk_applied(e, increases))
+                    raise
+            applied.extend(increases)
+            for name, num in decreases:
+                if name in cls._shards_:
+                    try:
+                        cls._take(name, -num)
+                    except CounterValueError:
+                        rejected[name] = num
+                        continue
+                elif not cls.collection.update_one(
+                        {'name': name, 'seq': {'$gte': -num}},
+                        {'$inc': {'seq': num}}).modified_count:
+                    rejected[name] = num
+                    continue
+                applied.append(name)
+        except PyMongoError as e:
+            e.applied = applied
+            raise
+        if rejected:
+            raise cls._rejected(rejected)
+
+    @staticmethod
+    def _rejected(rejected):
+        """Return the error of ``change_many`` for ``rejected`` changes."""
+        error = CounterValueError(
+            'Counter[%s] will be negative after the change.' % ', '.join(
+                '%s %+d' % item for item in sorted(rejected.items())))
+        error.deltas = rejected
+        return error
 
-        counter = cls.collection.find_and_modify(
+    @classmethod
+    @_instrumented('reserve')
+    def reserve(cls, name, num):
+        """Increase counter of ``name`` by ``num`` in one round trip, return
+        the reserved range as a tuple of its first and last value."""
+        if num < 1:
+            raise CounterValueError('Counter[%s] can not reserve %s' % (
+                                    name, num))
+        if name in cls._shards_:
+            raise CounterValueError('Sharded Counter[%s] can not reserve' %
+                                    name)
+        counter = cls.collection.find_one_and_update(
             {'name': name},
             {'$inc': {'seq': num}},
-            new=True,
+            return_document=ReturnDocument.AFTER,
             upsert=True
         )
-        return counter['seq']
+        return counter['seq'] - num + 1, counter['seq']
+
+    @classmethod
+    def allocator(cls, name, block_size=100, refill_at=0.2):
+        """Return an ``IdAllocator`` of counter ``name``."""
+        return IdAllocator(cls, name, block_size, refill_at)
 
     @classmethod
     def increase(cls, name):
@@ -293,12 +2427,274 @@ class Counter(Model):
         return cls.change_by(name, -1)
 
     @classmethod
-    def count(cls, name):
-        """Return the count of ``name``"""
-        counter = cls.collection.find_one({'name': name}) or {}
+    @_instrumented('count')
+    def count(cls, name, read=None):
+        """Return the count of ``name``, ``read`` is the same as in
+        ``Model.find``."""
+        collection = cls._reader(read)
+        if name in cls._shards_:
+            for counter in collection.aggregate([
+                    {'$match': {'name': name}},
+                    {'$group': {'_id': None, 'seq': {'$sum': '$seq'}}}]):
+                return counter['seq']
+            return 0
+        counter = collection.find_one({'name': name}) or {}
         return counter.get('seq', 0)
 
 
+def _bulk_applied(error, names):
+    """Return the names of the unordered bulk write requests of ``names``
+    made before it raised ``error``."""
+    failed = set(e['index'] for e in error.details.get('writeErrors', ()))
+    return [name for i, name in enumerate(names) if i not in failed]
+
+
+class CounterBuffer(object):
+    """Accumulates counter changes in process and writes them behind with
+    ``Counter.change_many``.
+
+    Changes rejected because they would make their counter negative are
+    kept in ``rejected``, changes failing on a ``PyMongoError`` are retried
+    after ``interval`` seconds."""
+    def __init__(self, counter, interval=1.0, size=1000):
+        self.counter = counter
+        self.interval = interval
+        self.size = size
+        self.rejected = {}
+        self._deltas = {}
+        self._changes = 0
+        self._timer = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+        _buffers.add(self)
+
+    def change_by(self, name, num):
+        """Buffer a change of counter ``name`` by ``num``."""
+        with self._lock:
+            self._deltas[name] = self._deltas.get(name, 0) + num
+            self._changes += 1
+            full = self._changes >= self.size
+            if not full:
+                self._schedule()
+        if full:
+            self.flush()
+
+    def _reset(self):
+        """Forget the changes and the timer inherited from the parent of a
+        forked process, the parent writes them."""
+        self._lock = threading.Lock()
+        self._deltas, self._changes = {}, 0
+        self._timer = None
+
+    def pending(self, name):
+        """Return the change of ``name`` not written yet."""
+        with self._lock:
+            return self._deltas.get(name, 0)
+
+    def _schedule(self):
+        """Start the flush timer if not started, called with the lock."""
+        if self._timer is None:
+            self._timer = threading.Timer(self.interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Write all buffered changes in one round trip, return the changes
+        rejected by this flush."""
+        with self._lock:
+            deltas, self._deltas, self._changes = self._deltas, {}, 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not deltas:
+            return {}
+        try:
+            self.counter.change_many(deltas)
+        except PyMongoError as e:
+            # keep the changes not made yet for the next flush
+            applied = set(getattr(e, 'applied', ()))
+            with self._lock:
+                for name, num in deltas.items():
+                    if name not in applied:
+                        self._deltas[name] = self._deltas.get(name, 0) + num
+                self._schedule()
+            logging.exception('Failed to flush counters')
+        except CounterValueError as e:
+            with self._lock:
+                for name, num in e.deltas.items():
+                    self.rejected[name] = self.rejected.get(name, 0) + num
+            logging.error('Counter changes rejected on flush: %s' % e)
+            return e.deltas
+        return {}
+
+
+class IdAllocator(object):
+    """Hands out sequential ids from blocks reserved with
+    ``Counter.reserve``, one round trip per block.
+
+    The next block is reserved in background once the ``refill_at`` share
+    of the current one is left. Ids of unused blocks are lost when the
+    allocator is discarded, so there can be gaps but never duplicates.
+
+    example::
+
+        >> ids = Counter.allocator('users', block_size=1000)
+        >> next(ids)
+        1
+    """
+    def __init__(self, counter, name, block_size=100, refill_at=0.2):
+        self.counter = counter
+        self.name = name
+        self.block_size = block_size
+        self.refill_at = int(block_size * refill_at)
+        self._next, self._last = 1, 0
+        self._spare = None
+        self._refilling = False
+        self._cond = threading.Condition()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._cond:
+            while self._next > self._last:
+                if self._spare:
+                    (self._next, self._last), self._spare = self._spare, None
+                elif self._refilling:
+                    self._cond.wait()
+                else:
+                    self._next, self._last = self.counter.reserve(
+                        self.name, self.block_size)
+            value = self._next
+            self._next += 1
+            if (self._last - value <= self.refill_at and
+                    not self._spare and not self._refilling):
+                self._refilling = True
+                refill = threading.Thread(target=self._refill)
+                refill.daemon = True
+                refill.start()
+            return value
+
+    next = __next__
+
+    def _refill(self):
+        block = None
+        try:
+            block = self.counter.reserve(self.name, self.block_size)
+        except Exception:
+            logging.exception('Failed to reserve Counter[%s]' % self.name)
+        finally:
+            with self._cond:
+                self._spare = block
+                self._refilling = False
+                self._cond.notify_all()
+
+
+class Metrics(object):
+    """Collects latency and throughput of model and counter operations,
+    activate it with ``set_metrics()``.
+
+    Operations slower than ``slow_threshold`` seconds are logged as
+    warnings. With ``measure_bytes`` the size of documents found is
+    measured by encoding them again, which is costly.
+
+    example::
+
+        >> metrics = set_metrics(Metrics(slow_threshold=0.1))
+        >> metrics.snapshot()
+        {('User', 'users', 'find_one'): {'count': 2, ...}}
+        >> print(metrics.prometheus())
+    """
+    fields = ('count', 'errors', 'seconds', 'max_seconds', 'docs', 'bytes')
+
+    def __init__(self, slow_threshold=None, measure_bytes=False):
+        self.slow_threshold = slow_threshold
+        self.measure_bytes = measure_bytes
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_cls, op, seconds, docs=0, nbytes=0, error=False):
+        """Record one ``op`` of ``model_cls`` which took ``seconds``."""
+        key = model_cls.__name__, model_cls._collection_, op
+        with self._lock:
+            stat = self._stats.get(key)
+            if stat is None:
+                stat = self._stats[key] = dict.fromkeys(self.fields, 0)
+            stat['count'] += 1
+            stat['errors'] += error
+            stat['seconds'] += seconds
+            stat['max_seconds'] = max(stat['max_seconds'], seconds)
+            stat['docs'] += docs
+            stat['bytes'] += nbytes
+        if self.slow_threshold is not None and seconds > self.slow_threshold:
+            logging.warning('Slow %s.%s on %s took %.3fs' % (
+                key[0], op, key[1], seconds))
+
+    def snapshot(self, by='model'):
+        """Return a copy of the statistics keyed by ``(model, collection,
+        op)``, or by ``(collection, op)`` if ``by`` is ``'collection'``."""
+        with self._lock:
+            stats = [(k, dict(v)) for k, v in self._stats.items()]
+        if by == 'model':
+            return dict(stats)
+        merged = {}
+        for (model, collection, op), stat in stats:
+            total = merged.get((collection, op))
+            if total is None:
+                merged[(collection, op)] = stat
+                continue
+            for field in self.fields:
+                if field == 'max_seconds':
+                    total[field] = max(total[field], stat[field])
+                else:
+                    total[field] += stat[field]
+        return merged
+
+    def reset(self):
+        """Drop all statistics."""
+        with self._lock:
+            self._stats.clear()
+
+    def prometheus(self, prefix='mongu'):
+        """Return the statistics in Prometheus text exposition format."""
+        metrics = (('operations_total', 'counter', 'count'),
+                   ('errors_total', 'counter', 'errors'),
+                   ('operation_seconds_total', 'counter', 'seconds'),
+                   ('operation_seconds_max', 'gauge', 'max_seconds'),
+                   ('documents_total', 'counter', 'docs'),
+                   ('bytes_total', 'counter', 'bytes'))
+        stats = sorted(self.snapshot().items())
+        lines = []
+        for name, kind, field in metrics:
+            name = '%s_%s' % (prefix, name)
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (model, collection, op), stat in stats:
+                lines.append('%s{model="%s",collection="%s",op="%s"} %s' % (
+                    name, model, collection, op, stat[field]))
+        return '\n'.join(lines) + '\n'
+
+
+def set_metrics(metrics):
+    """Activate ``metrics`` (a ``Metrics``) for all models, ``None``
+    disables instrumentation. Return ``metrics``."""
+    global _metrics
+    _metrics = metrics
+    return metrics
+
+
+def _after_fork():
+    for client in list(_clients):
+        # the lock may have been held by another thread of the parent
+        client._lock = threading.Lock()
+        client._reset()
+    for buffer in list(_buffers):
+        buffer._reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
 class MonguException(Exception):
     """Base class for exceptions from mongu."""
     pass
@@ -310,3 +2706,11 @@ class ModelAttributeError(MonguException):
 
 class CounterValueError(MonguException):
     pass
+
+
+class PartialModelError(MonguException):
+    pass
+
+
+class PageTokenError(MonguException):
+    pass
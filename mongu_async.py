@@ -0,0 +1,823 @@
+# -*- coding: utf-8 -*-
+"""asyncio variant of mongu, requires Python 3.7+ and pymongo's
+``AsyncMongoClient`` (pymongo 4.13+) or Motor.
+
+Models are shared with ``mongu``: registering a ``Model`` subclass on an
+``AsyncClient`` returns a subclass with coroutine methods, inheriting
+defaults, custom methods and hooks. Hooks may be plain methods or
+coroutines. Overrides of model methods such as ``save`` take precedence,
+they return what the ``super()`` call returns for the caller to await.
+
+example::
+
+    >> c = AsyncClient()
+    >> AsyncUser = c.register_model(User)
+    >> user = await AsyncUser.find_one({'username': 'Mongu'})
+    >> async for user in AsyncUser.find():
+    >>     await user.save()
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+import inspect
+import logging
+
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+import mongu
+from mongu import (Counter, CounterValueError, Model, _BULK_OPS,
+                   _bulk_applied, _chunked, _count_docs, _timer)
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:  # pragma: no cover
+    from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+
+
+async def _maybe_await(value):
+    if inspect.isawaitable(value):
+        value = await value
+    return value
+
+
+# only the outermost operation of a task is recorded
+_instrumenting = contextvars.ContextVar('instrumenting', default=False)
+# read preference of ``read_from()`` blocks and primary pins per task
+_read = contextvars.ContextVar('read', default=None)
+_pins = contextvars.ContextVar('pins', default=None)
+
+
+@contextlib.contextmanager
+def read_from(read, max_staleness=-1):
+    """Route reads of async models in this block and task, see
+    ``mongu.read_from``."""
+    token = _read.set(mongu._read_preference(read, max_staleness))
+    try:
+        yield
+    finally:
+        _read.reset(token)
+
+
+def _instrumented(op):
+    """Coroutine variant of ``mongu._instrumented``."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(owner, *args, **kwargs):
+            metrics = mongu._metrics
+            if metrics is None or _instrumenting.get():
+                return await func(owner, *args, **kwargs)
+            model_cls = owner if isinstance(owner, type) else type(owner)
+            token = _instrumenting.set(True)
+            start = _timer()
+            try:
+                result = await func(owner, *args, **kwargs)
+            except Exception:
+                metrics.record(model_cls, op, _timer() - start, error=True)
+                raise
+            finally:
+                _instrumenting.reset(token)
+            metrics.record(model_cls, op, _timer() - start,
+                           docs=_count_docs(result))
+            return result
+        return wrapper
+    return decorator
+
+
+class AsyncClient(mongu.Client):
+    """For Connecting to MongoDB with an async driver and registering model
+    classes."""
+    client_class = AsyncMongoClient
+
+    def __init__(self, *args, **kwargs):
+        """Accept arguments same as ``AsyncMongoClient``."""
+        super(AsyncClient, self).__init__(*args, **kwargs)
+
+    async def warm_up(self, connections=1):
+        """Connect now and create queued indexes, see
+        ``mongu.Client.warm_up``."""
+        client = self.client
+        await asyncio.gather(*[client.admin.command('ping')
+                               for i in range(connections)])
+        await self.ensure_indexes()
+        for model_cls in self._models:
+            model_cls.collection
+
+    def register_model(self, model_cls):
+        """Decorator for registering model, ``Model`` subclasses which are
+        not ``AsyncModel`` are registered as an async subclass of them."""
+        if not issubclass(model_cls, AsyncModel):
+            # overrides of the model come before the coroutine methods
+            model_cls = type(model_cls.__name__, (model_cls, AsyncModel),
+                             {'__module__': model_cls.__module__})
+        return super(AsyncClient, self).register_model(model_cls)
+
+    def _on_bind(self, model_cls):
+        """Indexes can not be created while binding a collection, they wait
+        for ``ensure_indexes()``."""
+
+    async def ensure_indexes(self):
+        """Create the declared indexes of models registered so far, e.g. at
+        application startup."""
+        unindexed, self._unindexed = self._unindexed, []
+        for i, model_cls in enumerate(unindexed):
+            try:
+                await model_cls.ensure_indexes()
+            except Exception:
+                for model_cls in unindexed[i:]:
+                    self._auto_index(model_cls)
+                raise
+
+    def enable_counter(self, base=None, database='counter',
+                       collection='counters', shards=None):
+        """Register the builtin counter model, return the registered
+        ``AsyncCounter`` class and the corresponding ``CounterMixin``."""
+        AsyncCounter._database_ = database
+        AsyncCounter._collection_ = collection
+        bases = (base, AsyncCounter) if base else (AsyncCounter,)
+        counter = self.register_model(type('Counter', bases, {
+            '_shards_': dict(shards or {})}))
+        deltas_var = contextvars.ContextVar('deltas', default=None)
+
+        async def change_counter(name, num):
+            deltas = deltas_var.get()
+            if deltas is None:
+                await counter.change_many({name: num})
+            else:
+                deltas[name] = deltas.get(name, 0) + num
+
+        async def batch_counter(hook):
+            """Run ``hook``, apply its counter changes at once."""
+            if deltas_var.get() is not None:
+                return await hook
+            deltas = {}
+            token = deltas_var.set(deltas)
+            try:
+                return await hook
+            finally:
+                deltas_var.reset(token)
+                await counter.change_many(deltas)
+
+        class CounterMixin(object):
+            """Mixin class for async model"""
+            @classmethod
+            async def inc_counter(cls):
+                """Wrapper for ``Counter.increase()``."""
+                return await counter.increase(cls._collection_)
+
+            @classmethod
+            async def dec_counter(cls):
+                """Wrapper for ``Counter.decrease()``."""
+                return await counter.decrease(cls._collection_)
+
+            @classmethod
+            async def chg_counter(cls, *args, **kwargs):
+                """Wrapper for ``Counter.change_by()``."""
+                return await counter.change_by(cls._collection_,
+                                               *args, **kwargs)
+
+            @classmethod
+            async def set_counter(cls, *args, **kwargs):
+                """Wrapper for ``Counter.set_to()``."""
+                return await counter.set_to(cls._collection_,
+                                            *args, **kwargs)
+
+            async def on_save(self, old_dict):
+                await _maybe_await(super(CounterMixin, self).on_save(
+                    old_dict))
+                if not old_dict.get('_id'):
+                    await change_counter(self._collection_, 1)
+
+            async def on_delete(self, *args, **kwargs):
+                await _maybe_await(super(CounterMixin, self).on_delete(
+                    *args, **kwargs))
+                await change_counter(self._collection_, -1)
+
+            @classmethod
+            async def on_save_many(cls, objs, old_dicts):
+                await batch_counter(_maybe_await(
+                    super(CounterMixin, cls).on_save_many(objs, old_dicts)))
+
+            @classmethod
+            async def on_delete_many(cls, objs):
+                await batch_counter(_maybe_await(
+                    super(CounterMixin, cls).on_delete_many(objs)))
+
+            @classmethod
+            async def count(cls):
+                """Return the current count of this collection."""
+                return await counter.count(cls._collection_)
+
+        logging.info('Async counter enabled on: %s.%s' % (database,
+                                                          collection))
+        return counter, CounterMixin
+
+
+def _unsupported(name, is_classmethod=True):
+    """Return a method of ``AsyncModel`` replacing the blocking ``name`` of
+    ``Model``, which can not iterate async cursors."""
+    def method(owner, *args, **kwargs):
+        cls = owner if isinstance(owner, type) else type(owner)
+        raise TypeError('%s.%s() is not supported by async models, use a '
+                        'model registered on a mongu.Client' % (
+                            cls.__name__, name))
+    method.__name__ = name
+    method.__doc__ = 'Not supported by async models, raises ``TypeError``.'
+    return classmethod(method) if is_classmethod else method
+
+
+class AsyncModel(Model):
+    """``Model`` with coroutine methods for an ``AsyncClient``."""
+    find_compact = _unsupported('find_compact')
+    find_columns = _unsupported('find_columns')
+    export = _unsupported('export')
+    import_ = _unsupported('import_')
+    split_ids = _unsupported('split_ids')
+    parallel_scan = _unsupported('parallel_scan')
+    load_missing = _unsupported('load_missing', is_classmethod=False)
+
+    @classmethod
+    def _routing(cls):
+        """Return the read preference of the current ``read_from()`` block
+        and the primary pins of this task."""
+        pins = _pins.get()
+        if pins is None:
+            pins = {}
+            _pins.set(pins)
+        return _read.get(), pins
+
+    @classmethod
+    @_instrumented('by_id')
+    async def by_id(cls, oid, fields=None, lazy=False, read=None):
+        """Find a model object by its ``ObjectId``,
+        ``oid`` can be string or ObjectId, ``fields`` and ``lazy`` are the
+        same as in ``find``."""
+        if oid:
+            oid = ObjectId(oid)
+            if fields is not None:
+                return await cls.find_one(oid, fields=fields, lazy=lazy,
+                                          read=read)
+            cache = cls._cache_
+            if cache is not None:
+                obj = cache.get(cls, oid)
+                if obj is not None:
+                    return obj
+            d = await cls._reader(read).find_one(oid)
+            if d:
+                obj = cls._hydrate(d)
+                if cache is not None:
+                    cache.put(obj)
+                return obj
+
+    @classmethod
+    async def ensure_indexes(cls):
+        """Create the indexes declared in ``_indexes_``."""
+        models = cls.index_models()
+        if models:
+            return await cls.collection.create_indexes(models)
+        return []
+
+    @classmethod
+    async def index_diff(cls):
+        """Compare declared indexes with the ones of the collection, see
+        ``Model.index_diff``."""
+        return cls._diff_indexes(await cls.collection.index_information())
+
+    @classmethod
+    @_instrumented('by_ids')
+    async def by_ids(cls, oids, read=None):
+        """Find model objects by a list of ``ObjectId`` with one ``$in``
+        query, return them in the order of ``oids``, ``None`` for missing
+        ones."""
+        oids = [ObjectId(oid) if oid else None for oid in oids]
+        found = {}
+        cache = cls._cache_
+        missing = set(oid for oid in oids if oid)
+        if cache is not None:
+            for oid in list(missing):
+                obj = cache.get(cls, oid)
+                if obj is not None:
+                    found[oid] = obj
+                    missing.discard(oid)
+        if missing:
+            async for obj in cls.find({'_id': {'$in': list(missing)}},
+                                      read=read):
+                found[obj._id] = obj
+                if cache is not None:
+                    cache.put(obj)
+        return [found.get(oid) for oid in oids]
+
+    @classmethod
+    def loader(cls):
+        """Return an ``AsyncLoader`` coalescing lookups of this model."""
+        return AsyncLoader(cls)
+
+    @classmethod
+    @_instrumented('delete_by_id')
+    async def delete_by_id(cls, oid):
+        """Delete a document from collection by its ``ObjectId``,
+        ``oid`` can be string or ObjectId"""
+        if oid:
+            oid = ObjectId(oid)
+            await cls.collection.delete_one({'_id': oid})
+            cls._pin_primary()
+            if cls._cache_ is not None:
+                cls._cache_.invalidate(cls, oid)
+
+    @classmethod
+    def from_cursor(cls, cursor, fields=None):
+        """Build model object from an async cursor."""
+        return cls._hydrate_cursor(cursor, 'find', fields)
+
+    @classmethod
+    async def _hydrate_cursor(cls, cursor, op, fields=None):
+        """Same as ``from_cursor``, recorded as ``op`` in the metrics."""
+        hydrate = cls._hydrator(fields)
+        metrics = mongu._metrics
+        if metrics is None or _instrumenting.get():
+            async for d in cursor:
+                yield hydrate(d)
+            return
+
+        cursor = cursor.__aiter__()
+        elapsed, docs, nbytes = 0.0, 0, 0
+        try:
+            while True:
+                start = _timer()
+                try:
+                    d = await cursor.__anext__()
+                except StopAsyncIteration:
+                    break
+                if metrics.measure_bytes:
+                    nbytes += len(mongu.BSON.encode(d))
+                obj = hydrate(d)
+                elapsed += _timer() - start
+                docs += 1
+                yield obj
+        finally:
+            metrics.record(cls, op, elapsed, docs=docs, nbytes=nbytes)
+
+    @classmethod
+    def find(cls, *args, **kwargs):
+        """Same as ``collection.find``, returns an async iterator of model
+        objects. ``fields`` is the same as in ``Model.find``, lazy loading
+        is not supported."""
+        fields = kwargs.pop('fields', None)
+        read = kwargs.pop('read', None)
+        if kwargs.pop('lazy', False):
+            raise TypeError('lazy loading is not supported by async models')
+        if fields is not None:
+            kwargs['projection'] = cls._projection(fields)
+        return cls.from_cursor(cls._reader(read).find(*args, **kwargs),
+                               fields)
+
+    @classmethod
+    async def aggregate(cls, pipeline, as_model=False, batch_size=None,
+                        allow_disk_use=False, read=None, **kwargs):
+        """Same as ``Model.aggregate``, returns an async iterator."""
+        if batch_size is not None:
+            kwargs['batchSize'] = batch_size
+        if allow_disk_use:
+            kwargs['allowDiskUse'] = True
+        cursor = await _maybe_await(
+            cls._reader(read).aggregate(list(pipeline), **kwargs))
+        if not as_model:
+            async for d in cursor:
+                yield d
+            return
+        model_cls = cls if as_model is True else as_model
+        async for obj in model_cls._hydrate_cursor(cursor, 'aggregate'):
+            yield obj
+
+    @classmethod
+    async def paginate(cls, query=None, sort_key='_id', page_size=20,
+                       after=None, before=None, direction=1, fields=None,
+                       read=None):
+        """Return a ``Page`` of model objects, see ``Model.paginate``."""
+        spec, sort = cls._seek(query, sort_key, after, before, direction)
+        objs = [obj async for obj in cls.find(
+            spec, sort=sort, limit=page_size + 1,
+            fields=cls._page_fields(fields, sort_key), read=read)]
+        return mongu.Page.build(objs, page_size, sort_key, direction, after,
+                                before)
+
+    @classmethod
+    @_instrumented('find_one')
+    async def find_one(cls, *args, **kwargs):
+        """Same as ``collection.find_one``, returns model object instead of
+        dict."""
+        if kwargs.get('fields') is not None:
+            if args and not isinstance(args[0], (dict, type(None))):
+                args = ({'_id': args[0]},) + args[1:]
+            async for obj in cls.find(*args, limit=1, **kwargs):
+                return obj
+            return None
+        kwargs.pop('fields', None)
+        kwargs.pop('lazy', None)
+        read = kwargs.pop('read', None)
+        cache = cls._cache_
+        if len(args) > 1 or kwargs.get('projection') is not None:
+            # projected documents are partial, never cached
+            cache = None
+        if cache is not None:
+            oid = cls._id_spec(args, kwargs)
+            if oid is not None:
+                return await cls.by_id(oid, read=read)
+        d = await cls._reader(read).find_one(*args, **kwargs)
+        if d:
+            obj = cls._hydrate(d)
+            if cache is not None:
+                cache.put(obj)
+            return obj
+
+    @_instrumented('reload')
+    async def reload(self, d=None):
+        """Reload model from given dict or database."""
+        if d or not self.id:
+            return super(AsyncModel, self).reload(d)
+        new_dict = self._hydrate(await self._reader().find_one(self._id))
+        dict.clear(self)
+        dict.update(self, new_dict)
+        self.__dict__['_changed_'] = ()
+        self.__dict__.pop('_projection_', None)
+        if self._cache_ is not None:
+            self._cache_.put(self)
+
+    @_instrumented('save')
+    async def save(self):
+        """Save model object to database, see ``Model.save``."""
+        old_dict = dict(self)
+        op = self._save_op()
+        if op:
+            method, args = op
+            try:
+                await getattr(self.collection, method)(*args)
+            except Exception:
+                # a retried save inserts again
+                if '_id' not in old_dict:
+                    dict.pop(self, '_id', None)
+                raise
+            self._pin_primary()
+        self._saved([self])
+        await _maybe_await(self.on_save(old_dict))
+        return self._id
+
+    @classmethod
+    async def on_save_many(cls, objs, old_dicts):
+        """Hook after ``save_many`` wrote a batch, calls ``on_save`` of each
+        model object by default."""
+        for obj, old_dict in zip(objs, old_dicts):
+            await _maybe_await(obj.on_save(old_dict))
+
+    @classmethod
+    @_instrumented('save_many')
+    async def save_many(cls, objs, batch_size=1000, ordered=True):
+        """Save model objects with one ``bulk_write`` per ``batch_size``
+        objects, return the list of their ``_id``."""
+        ids = []
+        for batch in _chunked(objs, batch_size):
+            old_dicts, requests, sent = [], [], []
+            for obj in batch:
+                old_dicts.append(dict(obj))
+                op = obj._save_op()
+                if op:
+                    method, args = op
+                    sent.append(obj)
+                    requests.append(_BULK_OPS[method](*args))
+            if requests:
+                try:
+                    await cls.collection.bulk_write(requests, ordered=ordered)
+                except Exception as e:
+                    batch, old_dicts = cls._written(e, batch, old_dicts,
+                                                    sent, ordered)
+                    cls._saved(batch)
+                    await cls.on_save_many(batch, old_dicts)
+                    raise
+                cls._pin_primary()
+            cls._saved(batch)
+            ids.extend(obj._id for obj in batch)
+            await cls.on_save_many(batch, old_dicts)
+        return ids
+
+    @_instrumented('delete')
+    async def delete(self):
+        """Remove from database."""
+        if not self.id:
+            return
+        await self.collection.delete_one({'_id': self._id})
+        self._pin_primary()
+        if self._cache_ is not None:
+            self._cache_.invalidate(self.__class__, self._id)
+        await _maybe_await(self.on_delete(self))
+
+    @classmethod
+    async def on_delete_many(cls, objs):
+        """Hook after ``delete_many`` removed a batch, calls ``on_delete`` of
+        each model object by default."""
+        for obj in objs:
+            await _maybe_await(obj.on_delete(obj))
+
+    @classmethod
+    @_instrumented('delete_many')
+    async def delete_many(cls, objs, batch_size=1000):
+        """Remove model objects with one ``delete_many`` per ``batch_size``
+        objects, unsaved ones are skipped."""
+        for batch in _chunked(objs, batch_size):
+            batch = [obj for obj in batch if obj.id]
+            if batch:
+                await cls.collection.delete_many(
+                    {'_id': {'$in': [obj._id for obj in batch]}})
+                cls._pin_primary()
+                if cls._cache_ is not None:
+                    for obj in batch:
+                        cls._cache_.invalidate(cls, obj._id)
+                await cls.on_delete_many(batch)
+
+
+class AsyncLoader(object):
+    """Coalesces ``load()`` calls of a model made in the same event loop
+    iteration into one ``by_ids`` query.
+
+    example::
+
+        >> loader = AsyncUser.loader()
+        >> owners = await asyncio.gather(
+        >>     *[loader.load(post.owner_id) for post in posts])  # one query
+    """
+    def __init__(self, model_cls):
+        self.model_cls = model_cls
+        self._queue = {}
+        self._loaded = {}
+
+    def load(self, oid):
+        """Return a future of the model object of ``oid`` (string or
+        ObjectId), ``None`` if not found."""
+        oid = ObjectId(oid)
+        future = self._loaded.get(oid) or self._queue.get(oid)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            if not self._queue:
+                loop.call_soon(self._dispatch)
+            future = self._queue[oid] = loop.create_future()
+        return future
+
+    def load_many(self, oids):
+        """Return a future of the model objects of ``oids``."""
+        return asyncio.gather(*[self.load(oid) for oid in oids])
+
+    def _dispatch(self):
+        queue, self._queue = self._queue, {}
+        self._loaded.update(queue)
+        asyncio.ensure_future(self._fetch(queue))
+
+    async def _fetch(self, queue):
+        try:
+            objs = await self.model_cls.by_ids(list(queue))
+        except Exception as e:
+            for oid, future in queue.items():
+                self._loaded.pop(oid, None)
+                future.set_exception(e)
+        else:
+            for future, obj in zip(queue.values(), objs):
+                future.set_result(obj)
+
+
+class AsyncIdAllocator(object):
+    """Same as ``mongu.IdAllocator`` with ``await allocator.next()``, the
+    next block is reserved in a task of the running loop.
+
+    example::
+
+        >> ids = AsyncCounter.allocator('users', block_size=1000)
+        >> await ids.next()
+        1
+    """
+    def __init__(self, counter, name, block_size=100, refill_at=0.2):
+        self.counter = counter
+        self.name = name
+        self.block_size = block_size
+        self.refill_at = int(block_size * refill_at)
+        self._next, self._last = 1, 0
+        self._spare = None
+        self._refilling = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while self._next > self._last:
+            if self._spare:
+                (self._next, self._last), self._spare = self._spare, None
+            else:
+                if self._refilling is None:
+                    self._refill()
+                # raises if reserving failed, _refilled runs first
+                await self._refilling
+        value = self._next
+        self._next += 1
+        if (self._last - value <= self.refill_at and
+                not self._spare and self._refilling is None):
+            self._refill()
+        return value
+
+    next = __anext__
+
+    def _refill(self):
+        self._refilling = asyncio.ensure_future(
+            self.counter.reserve(self.name, self.block_size))
+        self._refilling.add_done_callback(self._refilled)
+
+    def _refilled(self, task):
+        self._refilling = None
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logging.error('Failed to reserve Counter[%s]' % self.name,
+                          exc_info=task.exception())
+        else:
+            self._spare = task.result()
+
+
+class AsyncCounter(AsyncModel, Counter):
+    """Builtin counter model for an ``AsyncClient``, see ``Counter``."""
+    @classmethod
+    @_instrumented('set_to')
+    async def set_to(cls, name, num):
+        """Set counter of ``name`` to ``num``, not atomic for a sharded
+        counter, see ``Counter.set_to``."""
+        if num < 0:
+            raise CounterValueError('Counter[%s] can not be set to %s' % (
+                                    name, num))
+        elif name in cls._shards_:
+            await cls.collection.bulk_write([
+                UpdateMany({'name': name, 'shard': {'$ne': 0}},
+                           {'$set': {'seq': 0}}),
+                UpdateOne({'name': name, 'shard': 0},
+                          {'$set': {'seq': num}}, upsert=True),
+            ])
+            return num
+        else:
+            counter = await cls.collection.find_one_and_update(
+                {'name': name},
+                {'$set': {'seq': num}},
+                return_document=ReturnDocument.AFTER,
+                upsert=True
+            )
+            return counter['seq']
+
+    @classmethod
+    @_instrumented('change_by')
+    async def change_by(cls, name, num):
+        """Change counter of ``name`` by ``num`` (can be negative), see
+        ``Counter.change_by``."""
+        if name in cls._shards_:
+            if num < 0:
+                await cls._take(name, -num)
+            elif num:
+                await cls.collection.update_one(cls._spec(name),
+                                                {'$inc': {'seq': num}},
+                                                upsert=True)
+            return await cls.count(name, read='primary')
+        if num < 0:
+            spec = {'name': name, 'seq': {'$gte': -num}}
+        else:
+            spec = cls._spec(name)
+        counter = await cls.collection.find_one_and_update(
+            spec,
+            {'$inc': {'seq': num}},
+            return_document=ReturnDocument.AFTER,
+            upsert=num >= 0
+        )
+        if counter is None:
+            raise CounterValueError('Counter[%s] will be negative '
+                                    'after %+d.' % (name, num))
+        return counter['seq']
+
+    @classmethod
+    async def _take(cls, name, amount):
+        """Decrease sharded counter ``name`` by ``amount`` taken from its
+        documents, see ``Counter._take``."""
+        collection = cls.collection
+        result = await collection.update_one(
+            {'name': name, 'seq': {'$gte': amount}},
+            {'$inc': {'seq': -amount}})
+        if result.modified_count:
+            return
+        remaining = amount
+        async for d in collection.find({'name': name, 'seq': {'$gt': 0}},
+                                       sort=[('seq', -1)]):
+            while remaining and d and d['seq'] > 0:
+                take = min(remaining, d['seq'])
+                result = await collection.update_one(
+                    {'_id': d['_id'], 'seq': {'$gte': take}},
+                    {'$inc': {'seq': -take}})
+                if result.modified_count:
+                    remaining -= take
+                    break
+                d = await collection.find_one({'_id': d['_id']})
+            if not remaining:
+                return
+        if remaining < amount:
+            await collection.update_one(cls._spec(name),
+                                        {'$inc': {'seq': amount - remaining}},
+                                        upsert=True)
+        raise CounterValueError('Counter[%s] will be negative after %+d.' %
+                                (name, -amount))
+
+    @classmethod
+    @_instrumented('change_many')
+    async def change_many(cls, deltas):
+        """Change counters by the numbers of ``deltas``, see
+        ``Counter.change_many``."""
+        increases, updates, decreases = [], [], []
+        for name, num in deltas.items():
+            if num < 0:
+                decreases.append((name, num))
+            elif num:
+                increases.append(name)
+                updates.append((cls._spec(name), {'$inc': {'seq': num}}))
+        applied, rejected = [], {}
+        try:
+            if len(updates) == 1:
+                # the usual single change skips the bulk API
+                await cls.collection.update_one(*updates[0], upsert=True)
+            elif updates:
+                try:
+                    await cls.collection.bulk_write(
+                        [UpdateOne(spec, update, upsert=True)
+                         for spec, update in updates], ordered=False)
+                except BulkWriteError as e:
+                    applied.extend(_bulk_applied(e, increases))
+                    raise
+            applied.extend(increases)
+            for name, num in decreases:
+                if name in cls._shards_:
+                    try:
+                        await cls._take(name, -num)
+                    except CounterValueError:
+                        rejected[name] = num
+                        continue
+                else:
+                    result = await cls.collection.update_one(
+                        {'name': name, 'seq': {'$gte': -num}},
+                        {'$inc': {'seq': num}})
+                    if not result.modified_count:
+                        rejected[name] = num
+                        continue
+                applied.append(name)
+        except PyMongoError as e:
+            e.applied = applied
+            raise
+        if rejected:
+            raise cls._rejected(rejected)
+
+    @classmethod
+    @_instrumented('reserve')
+    async def reserve(cls, name, num):
+        """Increase counter of ``name`` by ``num`` in one round trip, return
+        the reserved range as a tuple of its first and last value."""
+        if num < 1:
+            raise CounterValueError('Counter[%s] can not reserve %s' % (
+                                    name, num))
+        if name in cls._shards_:
+            raise CounterValueError('Sharded Counter[%s] can not reserve' %
+                                    name)
+        counter = await cls.collection.find_one_and_update(
+            {'name': name},
+            {'$inc': {'seq': num}},
+            return_document=ReturnDocument.AFTER,
+            upsert=True
+        )
+        return counter['seq'] - num + 1, counter['seq']
+
+    @classmethod
+    def allocator(cls, name, block_size=100, refill_at=0.2):
+        """Return an ``AsyncIdAllocator`` of counter ``name``."""
+        return AsyncIdAllocator(cls, name, block_size, refill_at)
+
+    @classmethod
+    async def increase(cls, name):
+        """Increase counter of ``name`` by one."""
+        return await cls.change_by(name, 1)
+
+    @classmethod
+    async def decrease(cls, name):
+        """Decrease counter of ``name`` by one."""
+        return await cls.change_by(name, -1)
+
+    @classmethod
+    @_instrumented('count')
+    async def count(cls, name, read=None):
+        """Return the count of ``name``"""
+        collection = cls._reader(read)
+        if name in cls._shards_:
+            cursor = await _maybe_await(collection.aggregate([
+                {'$match': {'name': name}},
+                {'$group': {'_id': None, 'seq': {'$sum': '$seq'}}}]))
+            async for counter in cursor:
+                return counter['seq']
+            return 0
+        counter = await collection.find_one({'name': name}) or {}
+        return counter.get('seq', 0)
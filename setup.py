@@ -27,9 +27,14 @@ setup(name='mongu',
       author=__author__,
       author_email='mail2tevin@gmail.com',
       url='http://github.com/tevino/mongu',
-      py_modules=['mongu'],
+      py_modules=['mongu', 'mongu_async'],
       scripts=['mongu.py'],
-      install_requires=['pymongo>=2.7'],
+      install_requires=['pymongo>=3.5'],
+      extras_require={
+          # mongu_async runs on pymongo's AsyncMongoClient or Motor
+          'async': ['pymongo>=4.13'],
+          'motor': ['motor'],
+      },
       license=__license__,
       platforms='any',
       test_suite='tests.suite')
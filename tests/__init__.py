@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import sys
 from .test_model import ModelTests
 from .test_counter import CounterTests
 from .test_client import ClientTests
@@ -8,6 +9,10 @@ def suite():
     import unittest
     loader = unittest.TestLoader()
     suite = unittest.TestSuite()
-    for case in (ClientTests, ModelTests, CounterTests):
+    cases = [ClientTests, ModelTests, CounterTests]
+    if sys.version_info >= (3, 8):
+        from .test_async import AsyncModelTests, AsyncCounterTests
+        cases += [AsyncModelTests, AsyncCounterTests]
+    for case in cases:
         suite.addTests(loader.loadTestsFromTestCase(case))
     return suite
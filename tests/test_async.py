@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import unittest
+from mongu import CounterValueError, Metrics, set_metrics
+from .base import User
+
+try:
+    from mongu_async import AsyncClient, AsyncModel
+except ImportError:  # pymongo older than 4.13 without Motor
+    AsyncClient = AsyncModel = None
+
+
+@unittest.skipIf(AsyncClient is None, 'requires pymongo 4.13+ or Motor')
+class AsyncTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        c = AsyncClient()
+        self.User = c.register_model(User)
+        self.Counter, CounterMixin = c.enable_counter()
+
+        @c.register_model
+        class CountedUser(CounterMixin, AsyncModel):
+            _database_ = 'test'
+            _collection_ = 'async_counted_users'
+            _defaults_ = {'is_activated': False}
+
+        self.CountedUser = CountedUser
+        self.client = c
+
+    async def asyncTearDown(self):
+        await self.User.collection.drop()
+        await self.CountedUser.collection.drop()
+        await self.Counter.collection.drop()
+
+
+class AsyncModelTests(AsyncTestCase):
+    async def test_lazy(self):
+        # registering models and enabling the counter does not connect
+        self.assertEqual(self.client._client, None)
+
+    async def test_register(self):
+        assert issubclass(self.User, AsyncModel)
+        assert issubclass(self.User, User)
+        self.assertIsNot(User._mongo_client_, self.User._mongo_client_)
+        await self.client.ensure_indexes()
+        await self.client.warm_up(connections=2)
+        diff = await self.Counter.index_diff()
+        self.assertEqual(diff['missing'], [])
+
+    async def test_override(self):
+        class Stamped(User):
+            _collection_ = 'stamped_users'
+
+            def save(self):
+                self.stamped = True
+                return super(Stamped, self).save()
+
+        AsyncStamped = self.client.register_model(Stamped)
+        u = AsyncStamped(name='m')
+        await u.save()
+        self.assertEqual((await AsyncStamped.by_id(u.id)).stamped, True)
+        await AsyncStamped.collection.drop()
+
+    async def test_save_find(self):
+        u = self.User(username='Mongu')
+        assert isinstance(u.created_at, float)
+        await u.save()
+        found = await self.User.find_one({'username': 'Mongu'})
+        self.assertEqual(found, u)
+        found.activate()
+        await found.save()
+        self.assertEqual(
+            [user.is_activated async for user in self.User.find()], [True])
+        self.assertEqual(await self.User.by_id(u.id), found)
+
+        await u.reload()
+        assert u.is_activated
+        await u.delete()
+        self.assertEqual(await self.User.by_id(u._id), None)
+
+    async def test_save_many(self):
+        users = [self.User(name=name) for name in 'mongu']
+        ids = await self.User.save_many(users, batch_size=2)
+        found = await self.User.by_ids(ids[::-1])
+        self.assertEqual(found, users[::-1])
+        await self.User.delete_many(users[:2])
+        self.assertEqual(len([u async for u in self.User.find()]), 3)
+
+    async def test_metrics(self):
+        metrics = set_metrics(Metrics())
+        try:
+            u = self.User(name='mongu')
+            await u.save()
+            await self.User.by_id(u.id)
+            self.assertEqual(len([user async for user in self.User.find()]), 1)
+            self.assertEqual(len([user async for user in self.User.aggregate(
+                [{'$match': {}}], as_model=True)]), 1)
+        finally:
+            set_metrics(None)
+        stats = metrics.snapshot()
+        self.assertEqual(stats[('User', 'users', 'save')]['count'], 1)
+        self.assertEqual(stats[('User', 'users', 'by_id')]['docs'], 1)
+        self.assertEqual(stats[('User', 'users', 'find')]['docs'], 1)
+        self.assertEqual(stats[('User', 'users', 'aggregate')]['docs'], 1)
+
+    async def test_aggregate(self):
+        await self.User.save_many([self.User(name=name) for name in 'mongu'])
+        pipeline = self.User.pipeline().match(name={'$in': ['m', 'u']})
+        found = [u async for u in pipeline.aggregate(as_model=True)]
+        self.assertEqual(sorted(u.name for u in found), ['m', 'u'])
+        assert all(isinstance(u, self.User) for u in found)
+        rows = [row async for row in self.User.aggregate(
+            pipeline.group(None, total={'$sum': 1}))]
+        self.assertEqual(rows, [{'_id': None, 'total': 2}])
+
+    async def test_paginate(self):
+        users = [self.User(name=name) for name in 'mongu']
+        await self.User.save_many(users)
+        page = await self.User.paginate(page_size=3)
+        self.assertEqual(page, users[:3])
+        page = await self.User.paginate(page_size=3, after=page.next_token)
+        self.assertEqual(page, users[3:])
+        self.assertEqual(page.next_token, None)
+        page = await self.User.paginate(page_size=3, before=page.prev_token)
+        self.assertEqual(page, users[:3])
+
+    async def test_fields(self):
+        u = self.User(username='Mongu', age=18)
+        await u.save()
+        p = await self.User.only('age').find_one({'username': 'Mongu'})
+        self.assertEqual(p, {'_id': u._id, 'age': 18})
+        assert p.is_partial
+        p = await self.User.only('age').by_id(u.id)
+        self.assertEqual(p, {'_id': u._id, 'age': 18})
+        self.assertRaises(TypeError, self.User.find, lazy=True)
+
+    async def test_unsupported(self):
+        self.assertRaises(TypeError, self.User.export, '/tmp/users.bson')
+        self.assertRaises(TypeError, self.User.find_columns, {}, ['name'])
+        self.assertRaises(TypeError, self.User(name='m').load_missing)
+
+    async def test_loader(self):
+        users = [self.User(name=name) for name in 'mongu']
+        await self.User.save_many(users)
+        loader = self.User.loader()
+        found = await asyncio.gather(*[loader.load(u.id) for u in users])
+        self.assertEqual(found, users)
+        self.assertEqual(await loader.load_many([users[0]._id]), users[:1])
+
+
+class AsyncCounterTests(AsyncTestCase):
+    async def test_mixin(self):
+        users = [self.CountedUser(name=name) for name in 'mongu']
+        await users[0].save()
+        await users[0].save()
+        self.assertEqual(await self.CountedUser.count(), 1)
+        await self.CountedUser.save_many(users[1:])
+        self.assertEqual(await self.CountedUser.count(), 5)
+        await users[0].delete()
+        self.assertEqual(await self.CountedUser.count(), 4)
+
+    async def test_counter(self):
+        k = 'async'
+        self.assertEqual(await self.Counter.increase(k), 1)
+        self.assertEqual(await self.Counter.change_by(k, 2), 3)
+        with self.assertRaises(CounterValueError):
+            await self.Counter.change_by(k, -4)
+        self.assertEqual(await self.Counter.reserve(k, 3), (4, 6))
+        self.assertEqual(await self.Counter.set_to(k, 1), 1)
+        await self.Counter.decrease(k)
+        self.assertEqual(await self.Counter.count(k), 0)
+
+    async def test_sharded(self):
+        k = 'async_sharded'
+        self.Counter.shard(k, 8)
+        for i in range(16):
+            await self.Counter.change_many({k: 1})
+        self.assertEqual(await self.Counter.change_by(k, -10), 6)
+        with self.assertRaises(CounterValueError) as raised:
+            await self.Counter.change_many({k: -7})
+        self.assertEqual(raised.exception.deltas, {k: -7})
+        self.assertEqual(await self.Counter.count(k), 6)
+
+    async def test_allocator(self):
+        k = 'async_allocator'
+        ids = self.Counter.allocator(k, block_size=10)
+        found = await asyncio.gather(*[ids.next() for i in range(25)])
+        self.assertEqual(sorted(found), list(range(1, 26)))
+        self.assertTrue(await self.Counter.count(k) >= 30)
+
+        other = self.Counter.allocator(k, block_size=10)
+        async for oid in other:
+            assert oid > 25
+            break
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 from .base import TestCase
-from mongu import Client, Model, ModelAttributeError
-from pymongo import MongoClient
+import mongu
+from mongu import Client, Model, ModelAttributeError, MonguException, \
+    read_from
+from pymongo import MongoClient, ReadPreference, WriteConcern
+from pymongo.errors import OperationFailure
+from pymongo.read_preferences import Nearest, Secondary
 
 
 class ClientTests(TestCase):
@@ -16,6 +20,35 @@ class ClientTests(TestCase):
     def test_warning(self):
         self.assert_warn(SyntaxWarning, Client, 'mongodb://localhost:27017/database')
 
+    def test_lazy(self):
+        class Lazy(Model):
+            _database_ = 'test'
+            _collection_ = 'lazy'
+            _indexes_ = ['name']
+
+        c = Client()
+        c.register_model(Lazy)
+        c.enable_counter()
+        self.assertEqual(c._client, None)
+        collection = Lazy.collection
+        client = c._client
+        assert client is not None and c.client is client
+        assert Lazy.collection is collection
+
+        # a forked child builds its own client and collections
+        mongu._after_fork()
+        self.assertEqual(c._client, None)
+        assert Lazy.collection is not collection
+        assert c.client is not client
+        client = c.client
+        c._pid = -1
+        assert c.client is not client
+
+        Lazy._unbind_collection()
+        c.warm_up(connections=2)
+        assert '_bound_collection_' in vars(Lazy)
+        Lazy.collection.drop()
+
     def test_no_database(self):
         class BrokenModel(Model):
             _collection_ = 'test'
@@ -31,3 +64,128 @@ class ClientTests(TestCase):
             _database_ = 'test'
             _collection_ = 'test'
         self.assertRaises(ModelAttributeError, getattr, MyModel, 'collection')
+
+    def test_bound_collection(self):
+        class MyModel(Model):
+            _database_ = 'test'
+            _collection_ = 'test'
+            _write_concern_ = WriteConcern(w=0)
+            _read_preference_ = ReadPreference.SECONDARY_PREFERRED
+
+        class SubModel(MyModel):
+            pass
+
+        self.client.register_model(MyModel)
+        collection = MyModel.collection
+        assert MyModel.collection is collection
+        self.assertEqual(collection.name, 'test')
+        self.assertEqual(collection.write_concern, WriteConcern(w=0))
+        self.assertEqual(collection.read_preference,
+                         ReadPreference.SECONDARY_PREFERRED)
+        sub_collection = SubModel.collection
+
+        MyModel._collection_ = 'other'
+        self.assertEqual(MyModel.collection.name, 'other')
+        self.assertEqual(SubModel.collection.name, 'other')
+        assert SubModel.collection is not sub_collection
+
+    def test_read_routing(self):
+        class Routed(Model):
+            _database_ = 'test'
+            _collection_ = 'routed'
+            _read_preference_ = 'nearest'
+            _max_staleness_ = 120
+
+        Routed = self.client.register_model(Routed)
+        try:
+            self.assertEqual(Routed._reader().read_preference,
+                             Nearest(max_staleness=120))
+            reader = Routed._reader('secondary')
+            self.assertEqual(reader.read_preference,
+                             Secondary(max_staleness=120))
+            assert Routed._reader('secondary') is reader
+            self.assertEqual(Routed._reader(ReadPreference.PRIMARY)
+                             .read_preference, ReadPreference.PRIMARY)
+            self.assertRaises(MonguException, Routed._reader, 'anywhere')
+
+            with read_from('secondaryPreferred', max_staleness=90):
+                self.assertEqual(Routed._reader().read_preference.mode,
+                                 ReadPreference.SECONDARY_PREFERRED.mode)
+                self.assertEqual(Routed._reader('nearest').read_preference,
+                                 Nearest(max_staleness=120))
+                Routed(name='mongu').save()
+                # reads of this thread go to the primary right after a save
+                self.assertEqual(Routed._reader().read_preference,
+                                 ReadPreference.PRIMARY)
+                self.assertEqual(
+                    Routed.find_one({}, read='secondary').name, 'mongu')
+                Routed._read_your_writes_ = 0
+                Routed._routing()[1].clear()
+                self.assertEqual(Routed._reader().read_preference.mode,
+                                 ReadPreference.SECONDARY_PREFERRED.mode)
+            self.assertEqual(Routed._reader().read_preference,
+                             Nearest(max_staleness=120))
+        finally:
+            Routed.collection.drop()
+
+    def test_indexes(self):
+        class Indexed(Model):
+            _database_ = 'test'
+            _collection_ = 'indexed'
+            _indexes_ = [
+                'username',
+                [('created_at', -1), ('is_activated', 1)],
+                {'keys': 'email', 'unique': True, 'sparse': True},
+            ]
+
+        self.client.register_model(Indexed)
+        try:
+            # created on first use of the collection
+            self.assertEqual(self.client._unindexed, [Indexed])
+            info = Indexed.collection.index_information()
+            self.assertEqual(self.client._unindexed, [])
+            assert info['email_1']['unique']
+            self.assertEqual(list(info['created_at_-1_is_activated_1']['key']),
+                             [('created_at', -1), ('is_activated', 1)])
+            self.assertEqual(Indexed.index_diff(),
+                             {'missing': [], 'extra': [], 'changed': []})
+
+            Indexed.collection.drop_index('username_1')
+            Indexed.collection.create_index('age')
+            Indexed._indexes_ = Indexed._indexes_[1:] + [
+                {'keys': 'username', 'unique': True}]
+            self.assertEqual(Indexed.index_diff(), {
+                'missing': ['username_1'], 'extra': ['age_1'],
+                'changed': []})
+            Indexed.ensure_indexes()
+            self.assertEqual(Indexed.index_diff()['missing'], [])
+        finally:
+            Indexed.collection.drop()
+
+    def test_indexes_failure(self):
+        class Unauthorized(Model):
+            _database_ = 'test'
+            _collection_ = 'unauthorized'
+            _indexes_ = ['name']
+            failures = [OperationFailure('not authorized')]
+
+            @classmethod
+            def ensure_indexes(cls):
+                if cls.failures:
+                    raise cls.failures.pop()
+                return super(Unauthorized, cls).ensure_indexes()
+
+        self.client.register_model(Unauthorized)
+        try:
+            # the query still runs, the indexes wait for ensure_indexes()
+            self.assertEqual(Unauthorized.find_one(), None)
+            self.assertEqual(self.client._unindexed, [Unauthorized])
+            self.client.ensure_indexes()
+            self.assertEqual(self.client._unindexed, [])
+            assert 'name_1' in Unauthorized.collection.index_information()
+        finally:
+            Unauthorized.collection.drop()
+
+    def test_counter_index(self):
+        Counter, _ = self.client.enable_counter()
+        self.assertEqual(Counter.index_diff()['missing'], [])
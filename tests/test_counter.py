@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 from random import randint
-from mongu import CounterValueError
-from .base import CounterTestCase
+from pymongo.errors import AutoReconnect, PyMongoError
+from mongu import CounterBuffer, CounterValueError, Metrics, set_metrics
+from .base import CounterTestCase, User
 
 
 class CounterTests(CounterTestCase):
@@ -14,6 +15,48 @@ class CounterTests(CounterTestCase):
         # counter should only increases after the first save
         self.assertEqual(self.User.count(), 3)
 
+    def test_save_many(self):
+        users = [self.User(username=name) for name in 'Mongu']
+        self.User.save_many(users, batch_size=2)
+        self.assertEqual(self.User.count(), 5)
+        self.User.save_many(users)
+        self.assertEqual(self.User.count(), 5)
+        self.User.delete_many(users[:2])
+        self.assertEqual(self.User.count(), 3)
+
+    def test_failed_insert(self):
+        self.User.collection.create_index('username', unique=True)
+        self.User.collection.insert_one({'username': 'taken'})
+        u = self.User(username='taken')
+        self.assertRaises(PyMongoError, u.save)
+        assert '_id' not in u
+        self.User.collection.delete_one({'username': 'taken'})
+        u.save()
+        self.assertEqual(self.User.count(), 1)
+
+        users = [self.User(username=name) for name in ('a', 'taken', 'b')]
+        self.assertRaises(PyMongoError, self.User.save_many, users)
+        # written before the duplicate, the others can be saved again
+        self.assertEqual(['_id' in user for user in users],
+                         [True, False, False])
+        self.User.save_many(users[2:])
+        self.assertEqual(self.User.count(), 3)
+
+    def test_import(self):
+        import os
+        import tempfile
+        users = [self.User(username=name) for name in 'Mongu']
+        self.User.save_many(users)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.User.export(path)
+            self.User.collection.drop()
+            self.User.import_(path, batch_size=2)
+            self.assertEqual(self.User.count(), 10)
+        finally:
+            os.remove(path)
+
     def test_initial(self):
         self.assertEqual(0, self.Counter.count('something-new'))
 
@@ -68,9 +111,171 @@ class CounterTests(CounterTestCase):
         Counter, _ = self.client.enable_counter(base=CounterBase)
         self.assertEqual(Counter.increase_by_6('Final'), 6)
 
+    def test_buffered(self):
+        Counter, CounterMixin = self.client.enable_counter(
+            buffered=True, flush_interval=60, flush_size=4)
+
+        @self.client.register_model
+        class BufferedUser(CounterMixin, User):
+            _collection_ = 'buffered_user'
+
+        for name in 'Mon':
+            BufferedUser(username=name).save()
+        self.assertEqual(Counter.count(BufferedUser._collection_), 0)
+        self.assertEqual(BufferedUser.count(), 3)
+        BufferedUser(username='g').save()  # reaches flush_size
+        self.assertEqual(Counter.count(BufferedUser._collection_), 4)
+
+        BufferedUser.find_one().delete()
+        self.assertEqual(BufferedUser.count(), 3)
+        BufferedUser.flush_counter()
+        self.assertEqual(Counter.count(BufferedUser._collection_), 3)
+        BufferedUser.collection.drop()
+
+    def test_buffer_errors(self):
+        buffer = CounterBuffer(self.Counter, interval=60)
+        buffer.change_by('kept', 2)
+        buffer.change_by('negative', -1)
+        self.assertEqual(buffer.flush(), {'negative': -1})
+        self.assertEqual(buffer.rejected, {'negative': -1})
+        self.assertEqual(self.Counter.count('kept'), 2)
+
+        class Unreachable(object):
+            @staticmethod
+            def change_many(deltas):
+                raise AutoReconnect('unreachable')
+
+        buffer = CounterBuffer(Unreachable, interval=60)
+        buffer.change_by('retried', 1)
+        buffer.flush()
+        # kept and retried later
+        self.assertEqual(buffer.pending('retried'), 1)
+        assert buffer._timer is not None
+        buffer.counter = self.Counter
+        self.assertEqual(buffer.flush(), {})
+        self.assertEqual(self.Counter.count('retried'), 1)
+
+        class Failing(self.Counter):
+            _shards_ = {'taken': 2}
+
+            @classmethod
+            def _take(cls, name, amount):
+                raise AutoReconnect('unreachable')
+
+        # the increases were written before the decrease failed
+        self.Counter.set_to('taken', 1)
+        buffer = CounterBuffer(Failing, interval=60)
+        buffer.change_by('added', 3)
+        buffer.change_by('taken', -1)
+        buffer.flush()
+        self.assertEqual(self.Counter.count('added'), 3)
+        self.assertEqual(buffer.pending('added'), 0)
+        self.assertEqual(buffer.pending('taken'), -1)
+        buffer.counter = self.Counter
+        buffer.flush()
+        self.assertEqual(self.Counter.count('added'), 3)
+        self.assertEqual(self.Counter.count('taken'), 0)
+
+    def test_buffer_after_fork(self):
+        import mongu
+        buffer = CounterBuffer(self.Counter, interval=60)
+        buffer.change_by('forked', 1)
+        parent_timer = buffer._timer
+        mongu._after_fork()
+        # the parent writes its changes, the child starts empty
+        self.assertEqual(buffer.pending('forked'), 0)
+        buffer.change_by('forked', 2)
+        assert buffer._timer is not None and buffer._timer is not parent_timer
+        parent_timer.cancel()
+        buffer.flush()
+        self.assertEqual(self.Counter.count('forked'), 2)
+
+    def test_change_many(self):
+        self.Counter.change_many({'a': 2, 'b': 1})
+        self.Counter.change_many({'a': -1, 'b': 0})
+        self.assertEqual(self.Counter.count('a'), 1)
+        self.assertEqual(self.Counter.count('b'), 1)
+        with self.assertRaises(CounterValueError) as raised:
+            self.Counter.change_many({'a': -2, 'b': -1, 'c': 3})
+        # the other changes are made, the rejected ones reported
+        self.assertEqual(raised.exception.deltas, {'a': -2})
+        self.assertEqual(self.Counter.count('b'), 0)
+        self.assertEqual(self.Counter.count('c'), 3)
+
+    def test_sharded(self):
+        k = 'sharded'
+        self.Counter.increase(k)  # existing single document is kept
+        self.Counter.shard(k, 4)
+        for i in range(20):
+            self.Counter.change_many({k: 1})
+        self.assertEqual(self.Counter.increase(k), 22)
+        self.assertTrue(
+            1 < self.Counter.collection.count_documents({'name': k}) <= 5)
+
+        for i in range(22):
+            self.Counter.decrease(k)
+        self.assertEqual(self.Counter.count(k), 0)
+        self.assertRaises(CounterValueError, self.Counter.decrease, k)
+
+        # decreases are spread over the documents of the counter
+        self.Counter.shard(k, 16)
+        for i in range(32):
+            self.Counter.change_many({k: 1})
+        self.assertEqual(self.Counter.change_by(k, -20), 12)
+        self.Counter.change_many({k: -10})
+        self.assertEqual(self.Counter.count(k), 2)
+        self.assertRaises(CounterValueError, self.Counter.change_by, k, -3)
+        self.assertEqual(self.Counter.count(k), 2)
+
+        self.Counter.change_by(k, 10)
+        self.assertEqual(self.Counter.set_to(k, 5), 5)
+        self.assertEqual(self.Counter.count(k), 5)
+        self.assertEqual(self.Counter.count('unsharded'), 0)
+
+    def test_reserve(self):
+        k = 'reserve'
+        self.assertEqual(self.Counter.reserve(k, 10), (1, 10))
+        self.assertEqual(self.Counter.reserve(k, 5), (11, 15))
+        self.assertRaises(CounterValueError, self.Counter.reserve, k, 0)
+        self.Counter.shard(k, 2)
+        self.assertRaises(CounterValueError, self.Counter.reserve, k, 1)
+
+    def test_metrics(self):
+        metrics = set_metrics(Metrics())
+        try:
+            self.Counter.change_by('metrics', 2)
+            self.assertRaises(CounterValueError,
+                              self.Counter.change_by, 'metrics', -3)
+            self.Counter.count('metrics')
+        finally:
+            set_metrics(None)
+        stats = metrics.snapshot()
+        key = 'Counter', 'counters'
+        self.assertEqual(stats[key + ('change_by',)]['count'], 2)
+        self.assertEqual(stats[key + ('change_by',)]['errors'], 1)
+        self.assertEqual(stats[key + ('count',)]['count'], 1)
+
+    def test_allocator(self):
+        k = 'allocator'
+        ids = self.Counter.allocator(k, block_size=10)
+        self.assertEqual([next(ids) for i in range(25)], list(range(1, 26)))
+        self.assertTrue(self.Counter.count(k) >= 30)
+
+        other = self.Counter.allocator(k, block_size=10)
+        assert next(other) > 25
+
     def test_change_by_exception(self):
         self.assertRaises(CounterValueError, self.Counter.change_by, 'exception', -9999)
 
+    def test_change_by_guard(self):
+        k = 'guard'
+        self.Counter.set_to(k, 2)
+        self.assertRaises(CounterValueError, self.Counter.change_by, k, -3)
+        self.assertEqual(self.Counter.count(k), 2)
+        self.assertEqual(self.Counter.change_by(k, -2), 0)
+        self.assertRaises(CounterValueError, self.Counter.decrease, k)
+        self.assertEqual(self.Counter.count(k), 0)
+
     def test_on_delete(self):
         user = self.User(username='xx')
         user.save()
@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
 from bson import ObjectId
 from bson.errors import InvalidId
-from .base import TestCase
+from pymongo.errors import OperationFailure
+from mongu import (IdentityMap, Metrics, Model, MonguException,
+                   PageTokenError, PartialModelError, Watcher, set_metrics)
+from .base import TestCase, Admin
 
 
 class ModelTests(TestCase):
@@ -20,6 +27,23 @@ class ModelTests(TestCase):
             a.activate()
             assert a.is_activated
 
+    def test_defaults_mro(self):
+        class SuperAdmin(self.User):
+            _defaults_ = {'is_activated': True}
+
+        class Root(SuperAdmin):
+            _defaults_ = {'level': 9}
+
+        root = Root()
+        self.assertEqual(root.level, 9)
+        assert root.is_activated
+        assert isinstance(root.created_at, float)
+
+        SuperAdmin._defaults_ = {'is_super': True}
+        root = Root()
+        assert root.is_super
+        assert not root.is_activated
+
     def test_method(self):
         with self.new_user() as u:
             u.activate()
@@ -42,12 +66,67 @@ class ModelTests(TestCase):
         somebody = self.User.find_one({'name': '!'})
         assert isinstance(somebody, self.User)
 
+    def test_hydrate(self):
+        doc = {'_id': ObjectId(), 'username': 'Mongu', 'created_at': 1.0}
+        u = self.User._hydrate(doc)
+        assert isinstance(u, self.User)
+        self.assertEqual(u.created_at, 1.0)
+        assert not u.is_activated
+        self.assertEqual(u, dict(doc, is_activated=False))
+        assert 'is_activated' not in doc
+
+        a = Admin._hydrate({'username': 'Mongu'})
+        self.assertEqual(a.role, 'admin')
+        assert isinstance(a.created_at, float)
+
     def test_save(self):
         with self.new_user() as u:
             assert '_id' not in u
             u.save()
             assert '_id' in u
 
+    def test_partial_update(self):
+        with self.new_user(save=True) as u:
+            u = self.User.by_id(u._id)
+            self.User.collection.update_one({'_id': u._id},
+                                            {'$set': {'age': 18}})
+            u.activate()
+            del u['username']
+            u.save()
+            d = self.User.collection.find_one(u._id)
+            self.assertEqual(d['age'], 18)
+            assert d['is_activated']
+            assert 'username' not in d
+
+    def test_mark_changed(self):
+        with self.new_user() as u:
+            u.profile = {'age': 17}
+            u.save()
+            u = self.User.by_id(u._id)
+            u.profile['age'] = 18
+            u.mark_changed('profile')
+            u.save()
+            self.assertEqual(self.User.by_id(u._id).profile['age'], 18)
+
+    def test_save_many(self):
+        users = [self.User(name=name) for name in 'mongu']
+        ids = self.User.save_many(iter(users), batch_size=2)
+        self.assertEqual(ids, [u._id for u in users])
+        self.assertEqual(self.User.collection.count_documents({}), 5)
+
+        users[0].name = 'M'
+        users[1]['age'] = 1
+        self.User.save_many(users)
+        self.assertEqual(self.User.by_id(ids[0]).name, 'M')
+        self.assertEqual(self.User.by_id(ids[1]).age, 1)
+
+    def test_delete_many(self):
+        users = [self.User(name=name) for name in 'mongu']
+        self.User.save_many(users)
+        self.User.delete_many(users[:3] + [self.User()], batch_size=2)
+        self.assertEqual(
+            sorted(u.name for u in self.User.find()), ['g', 'u'])
+
     def test_id(self):
         with self.new_user(save=True) as u:
             assert u.id == str(u._id)
@@ -57,6 +136,384 @@ class ModelTests(TestCase):
         self.assertRaises(InvalidId, self.User.by_id, 'blabla')
         self.assertEqual(self.User.by_id(ObjectId()), None)
 
+    def test_cache(self):
+        self.User._cache_ = cache = IdentityMap(max_size=2)
+        try:
+            with self.new_user(save=True) as u:
+                a = self.User.by_id(u.id)
+                assert a is u
+                assert self.User.find_one({'_id': u._id}) is u
+                self.assertEqual(cache.stats(),
+                                 {'hits': 2, 'misses': 0, 'size': 1})
+
+                cache.clear()
+                a = self.User.by_id(u._id)
+                assert a is not u and a is self.User.by_id(u._id)
+                self.assertEqual(cache.stats()['misses'], 1)
+
+                self.User.delete_by_id(u._id)
+                self.assertEqual(self.User.by_id(u._id), None)
+
+            with self.new_user(save=True) as u:
+                p = self.User.find_one(u._id, fields=['age'])
+                p.age = 3
+                p.save()
+                cache.clear()
+                self.User.find_one({'_id': u._id}, {'age': 1})
+                self.User.find_one({'_id': u._id}, projection=['age'])
+                self.assertEqual(self.User.by_id(u._id).username, 'Mongu')
+                # partial model objects are not cached
+                found = self.User.by_id(u._id)
+                assert not found.is_partial
+                self.assertEqual((found.username, found.age), ('Mongu', 3))
+
+            cache.copy = True
+            with self.new_user(save=True) as u:
+                a = self.User.by_id(u._id)
+                self.assertEqual(a, u)
+                assert a is not u and a is not self.User.by_id(u._id)
+        finally:
+            del self.User._cache_
+
+    def test_cache_scope(self):
+        self.User._cache_ = cache = IdentityMap(scoped=True, ttl=60)
+        try:
+            with self.new_user(save=True) as u:
+                assert self.User.by_id(u._id) is not self.User.by_id(u._id)
+                with cache.scope():
+                    a = self.User.by_id(u._id)
+                    assert a is self.User.by_id(u._id)
+                assert self.User.by_id(u._id) is not a
+        finally:
+            del self.User._cache_
+
+    def test_watcher(self):
+        self.User._cache_ = cache = IdentityMap()
+        tmp = tempfile.mkdtemp()
+        try:
+            users = [self.User(name=name) for name in 'mongu']
+            self.User.save_many(users)
+            watcher = Watcher([self.User], patch=True,
+                              resume_file=os.path.join(tmp, 'tokens.json'))
+            deletes = []
+            watcher.subscribe(lambda cls, change: deletes.append(change),
+                              self.User, operations=['delete'])
+
+            def change(op, obj, **kwargs):
+                kwargs.update(operationType=op, documentKey={'_id': obj._id})
+                watcher.handle(self.User, kwargs)
+
+            change('update', users[0], fullDocument=dict(users[0], age=9))
+            self.assertEqual(self.User.by_id(users[0]._id).age, 9)
+            change('update', users[1])
+            assert self.User.by_id(users[1]._id) is not users[1]
+            change('delete', users[2])
+            self.assertEqual(cache.stats()['size'], 4)
+            self.assertEqual([c['documentKey']['_id'] for c in deletes],
+                             [users[2]._id])
+            change('drop', users[3])
+            self.assertEqual(cache.stats()['size'], 0)
+
+            watcher.tokens['test.users'] = {'_data': '8263'}
+            watcher.save_tokens()
+            self.assertEqual(Watcher(resume_file=watcher.resume_file).tokens,
+                             watcher.tokens)
+        finally:
+            del self.User._cache_
+            shutil.rmtree(tmp)
+
+    def test_watcher_errors(self):
+        class Failing(object):
+            attempts = 0
+
+            def __init__(self, code):
+                self.code = code
+
+            def watch(self, **kwargs):
+                self.attempts += 1
+                raise OperationFailure('failed', self.code)
+
+        class Watched(Model):
+            _database_ = 'test'
+            _collection_ = 'watched'
+
+        # a standalone server can not be followed, give up at once
+        collection = Failing(40573)
+        type.__setattr__(Watched, '_bound_collection_', collection)
+        Watcher([Watched])._follow(Watched)
+        self.assertEqual(collection.attempts, 1)
+
+        # other errors are retried with backoff
+        collection = Failing(11600)
+        type.__setattr__(Watched, '_bound_collection_', collection)
+        watcher = Watcher([Watched], retry_wait=0.01).start()
+        time.sleep(0.1)
+        watcher.stop()
+        assert 2 <= collection.attempts <= 5, collection.attempts
+
+    def test_by_ids(self):
+        users = [self.User(name=name) for name in 'mongu']
+        self.User.save_many(users)
+        missing = ObjectId()
+        ids = [users[2].id, users[0]._id, missing, users[2]._id, '']
+        found = self.User.by_ids(ids)
+        self.assertEqual(found[:2], [users[2], users[0]])
+        self.assertEqual(found[2], None)
+        assert found[3] is found[0]
+        self.assertEqual(found[4], None)
+
+    def test_loader(self):
+        users = [self.User(name=name) for name in 'mongu']
+        self.User.save_many(users)
+        loader = self.User.loader()
+        deferred = loader.load_many(u.id for u in reversed(users))
+        missing = loader.load(ObjectId())
+        self.assertEqual([d.get() for d in deferred], users[::-1])
+        self.assertEqual(missing.get(), None)
+        assert loader.load(users[0]._id).get() is deferred[-1].get()
+
+    def test_fields(self):
+        with self.new_user(save=True) as u:
+            self.User.collection.update_one({'_id': u._id},
+                                            {'$set': {'age': 18}})
+            p = self.User.find_one({'username': 'Mongu'}, fields=['age'])
+            self.assertEqual(p, {'_id': u._id, 'age': 18})
+            assert p.is_partial
+            self.assertRaises(AttributeError, getattr, p, 'username')
+            p.age = 19
+            p.save()
+            d = self.User.collection.find_one(u._id)
+            self.assertEqual((d['age'], d['username']), (19, 'Mongu'))
+
+            p = self.User.exclude('age').by_id(u.id)
+            assert 'age' not in p
+            assert 'is_activated' in p
+            p._id = ObjectId()
+            self.assertRaises(PartialModelError, p.save)
+
+            p = self.User.find_one(u._id, fields={'_id': 0, 'age': 1})
+            self.assertRaises(PartialModelError, p.save)
+            self.assertEqual(self.User.collection.count_documents({}), 1)
+
+    def test_lazy_fields(self):
+        with self.new_user(save=True) as u:
+            p = list(self.User.only('is_activated').lazy().find())[0]
+            self.assertEqual(set(p), set(['is_activated', '_id']))
+            p.is_activated = True
+            self.assertEqual(p.username, 'Mongu')
+            assert p.is_activated
+            assert not p.is_partial
+            self.assertEqual(set(p), set(u))
+
+    def test_export_import(self):
+        users = [self.User(name=name) for name in 'mongu']
+        self.User.save_many(users)
+        tmp = tempfile.mkdtemp()
+        try:
+            for name, fmt in (('users.bson', 'bson'), ('users.json.gz', 'json')):
+                path = os.path.join(tmp, name)
+                checkpoints = []
+                self.assertEqual(
+                    self.User.export(path, {'name': {'$ne': 'o'}}, fmt,
+                                     batch_size=3,
+                                     progress=lambda *c: checkpoints.append(c)),
+                    (4, users[-1]._id))
+                self.assertEqual(checkpoints, [(3, users[3]._id),
+                                               (4, users[4]._id)])
+                self.assertEqual(
+                    self.User.export(path + '.tail', format=fmt,
+                                     after=users[2]._id),
+                    (2, users[-1]._id))
+
+                self.User.collection.drop()
+                self.assertEqual(self.User.import_(path, fmt, batch_size=3,
+                                                   after=users[0]._id),
+                                 (3, users[-1]._id))
+                self.assertEqual(sorted(u.name for u in self.User.find()),
+                                 ['g', 'n', 'u'])
+                self.User.collection.drop()
+                self.User.import_(path, fmt, hooks=True)
+                self.assertEqual(self.User.by_id(users[0]._id), users[0])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_parallel_scan(self):
+        users = [self.User(name=name, n=i) for i, name in enumerate('mongu' * 20)]
+        self.User.save_many(users)
+        points = self.User.split_ids(num=4)
+        assert 1 <= len(points) <= 3
+        self.assertEqual(points, sorted(points))
+
+        ns = list(self.User.parallel_scan({'name': {'$ne': 'o'}},
+                                          fn=lambda u: u.n, workers=3,
+                                          ordered=True))
+        self.assertEqual(ns, [u.n for u in users if u.name != 'o'])
+        found = list(self.User.parallel_scan(workers=2, partitions=1))
+        self.assertEqual(sorted(u._id for u in found),
+                         [u._id for u in users])
+
+    def test_compact(self):
+        with self.new_user(save=True) as u:
+            u['foo-bar'] = 1
+            c = u.to_compact()
+            self.assertEqual(c.__class__.__name__, 'CompactUser')
+            assert not hasattr(c, '__dict__')
+            self.assertEqual((c._id, c.username, c['foo-bar']),
+                             (u._id, 'Mongu', 1))
+            assert 'is_activated' in c and 'age' not in c
+            self.assertRaises(AttributeError, getattr, c, 'age')
+            self.assertEqual(c, u)
+            self.assertEqual(c.to_model(), u)
+            assert isinstance(c.to_model(), self.User)
+
+            found = list(self.User.find_compact())
+            self.assertEqual(found, [self.User.by_id(u._id)])
+            self.assertEqual(found[0].username, 'Mongu')
+
+    def test_find_columns(self):
+        self.User.save_many([
+            self.User(name='a', age=1, created_at=1.0, profile={'x': 1}),
+            self.User(name='b', age=None, is_activated=True),
+            self.User(name='c', age=3.5, profile={'x': 'y'}),
+        ])
+        self.User.collection.update_one({'name': 'c'},
+                                        {'$unset': {'is_activated': 1}})
+        columns = self.User.find_columns(
+            {}, ['age', 'created_at', 'is_activated', 'profile.x'],
+            sort=[('name', 1)])
+        self.assertEqual(list(columns), ['age', 'created_at', 'is_activated',
+                                         'profile.x'])
+        self.assertEqual(list(columns['age']), [1, None, 3.5])
+        self.assertEqual(list(columns['age'].mask), [1, 0, 1])
+        self.assertEqual(columns['is_activated'].values.typecode, 'b')
+        self.assertEqual(list(columns['is_activated']), [False, True, False])
+        self.assertEqual(columns['created_at'].values.typecode, 'd')
+        self.assertEqual(columns['created_at'][0], 1.0)
+        self.assertEqual(list(columns['profile.x']), [1, None, 'y'])
+
+    def test_aggregate(self):
+        class Post(Model):
+            _database_ = 'test'
+            _collection_ = 'posts'
+            _defaults_ = {'tags': list}
+
+        Post = self.client.register_model(Post)
+        try:
+            users = [self.User(username=name, role=role)
+                     for name, role in zip('mongu', 'aabba')]
+            self.User.save_many(users)
+            Post.collection.insert_many([{'user_id': users[0]._id}
+                                        for i in range(2)])
+
+            rows = self.User.pipeline().match(role='a').group(
+                '$role', users={'$sum': 1}).aggregate(batch_size=10)
+            self.assertEqual(list(rows), [{'_id': 'a', 'users': 3}])
+
+            pipeline = (self.User.pipeline()
+                        .match({'username': 'm'})
+                        .lookup(Post, '_id', 'user_id')
+                        .stage('$project', {'posts': 1}))
+            found = list(pipeline.aggregate(as_model=True,
+                                            allow_disk_use=True))
+            self.assertEqual(len(found), 1)
+            assert isinstance(found[0], self.User)
+            self.assertEqual(len(found[0].posts), 2)
+            assert found[0].is_activated is False
+
+            posts = list(self.User.aggregate(
+                [{'$lookup': {'from': 'posts', 'localField': '_id',
+                              'foreignField': 'user_id', 'as': 'p'}},
+                 {'$unwind': '$p'}, {'$replaceRoot': {'newRoot': '$p'}}],
+                as_model=Post))
+            self.assertEqual([p.tags for p in posts], [[], []])
+
+            other = type('OtherPost', (Post,), {'_database_': 'other'})
+            self.assertRaises(MonguException, self.User.pipeline().lookup,
+                              other, '_id', 'user_id')
+        finally:
+            Post.collection.drop()
+
+    def test_paginate(self):
+        users = [self.User(username=name, age=age)
+                 for name, age in zip('mongudb', [3, 1, 3, 2, 1, 3, 2])]
+        self.User.save_many(users)
+        expected = sorted(users, key=lambda u: (u.age, u._id), reverse=True)
+
+        page = self.User.paginate(page_size=3)
+        self.assertEqual(page, users[:3])
+        self.assertEqual(page.prev_token, None)
+
+        pages = []
+        page = self.User.paginate(sort_key='age', direction=-1, page_size=3)
+        while True:
+            pages.append(page)
+            if not page.next_token:
+                break
+            page = self.User.paginate(sort_key='age', direction=-1,
+                                      page_size=3, after=page.next_token)
+        self.assertEqual([len(p) for p in pages], [3, 3, 1])
+        self.assertEqual(sum(pages, []), expected)
+
+        back = self.User.paginate(sort_key='age', direction=-1, page_size=3,
+                                  before=pages[2].prev_token)
+        self.assertEqual(back, pages[1])
+        back = self.User.paginate(sort_key='age', direction=-1, page_size=3,
+                                  before=back.prev_token)
+        self.assertEqual(back, pages[0])
+        self.assertEqual(back.prev_token, None)
+        self.assertEqual(back.next_token, pages[0].next_token)
+
+        page = self.User.paginate({'age': 3}, 'age', page_size=2,
+                                  fields=['age'])
+        self.assertEqual([u._id for u in page],
+                         [u._id for u in users if u.age == 3][:2])
+        self.assertRaises(PageTokenError, self.User.paginate,
+                          after=page.next_token)
+        self.assertRaises(PageTokenError, self.User.paginate, after='x!')
+
+        # the sort key is projected even if left out of fields
+        for fields in (['username'], {'age': 0, '_id': 0}):
+            page = self.User.paginate(sort_key='age', direction=-1,
+                                      page_size=3, fields=fields)
+            page = self.User.paginate(sort_key='age', direction=-1,
+                                      page_size=3, fields=fields,
+                                      after=page.next_token)
+            self.assertEqual([u._id for u in page],
+                             [u._id for u in pages[1]])
+
+    def test_metrics(self):
+        metrics = set_metrics(Metrics(measure_bytes=True))
+        try:
+            with self.new_user(save=True) as u:
+                self.User.by_id(u._id)
+                self.assertEqual(len(list(self.User.find())), 1)
+                self.assertRaises(InvalidId, self.User.by_id, 'x')
+                self.User.find_columns({}, ['username'])
+                list(self.User.aggregate([{'$match': {}}], as_model=True))
+        finally:
+            set_metrics(None)
+        stats = metrics.snapshot()
+        key = 'User', 'users'
+        self.assertEqual(stats[key + ('save',)]['count'], 1)
+        self.assertEqual(stats[key + ('by_id',)]['count'], 2)
+        self.assertEqual(stats[key + ('by_id',)]['errors'], 1)
+        self.assertEqual(stats[key + ('by_id',)]['docs'], 1)
+        # the find_one inside by_id is not recorded
+        self.assertNotIn(key + ('find_one',), stats)
+        self.assertEqual(stats[key + ('find',)]['docs'], 1)
+        assert stats[key + ('find',)]['bytes'] > 0
+        self.assertEqual(stats[key + ('find_columns',)]['docs'], 1)
+        self.assertEqual(stats[key + ('aggregate',)]['docs'], 1)
+        self.assertEqual(metrics.snapshot(by='collection')[
+            ('users', 'by_id')]['count'], 2)
+        assert ('mongu_operations_total{model="User",collection="users",'
+                'op="save"} 1\n') in metrics.prometheus()
+
+        self.User.find_one()
+        self.assertNotIn(key + ('find_one',), metrics.snapshot())
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {})
+
     def test_reload(self):
         with self.new_user(save=True) as u:
             u.collection.find_and_modify(